@@ -4,53 +4,729 @@
 # Features:
 # - /resim slash command with optional params
 # - safety filter handling
-# - concurrency limter + per-user cooldown
-# - usage logging (sqlite)
+# - adaptive (AIMD) concurrency limiter + per-user cooldown
+# - usage logging (sqlite, batched on a writer thread)
+# - persistent job queue, resumed after restarts
+# - weighted fair queuing across guilds / users
+# - queue position / ETA updates on the deferred response
+# - deadlines tied to the interaction token (load shedding, cancellation)
+# - optional fan-out of multi-sample requests with progressive delivery
+# - all samples of a job delivered in one followup message
+# - optional grid compositing of multi-sample results (Pillow)
+# - re-encoding to fit the guild upload size limit
+# - CPU work (decoding, Pillow) offloaded to bounded worker pools
+# - pipelined per-sample decode / encode / upload
+# - slash commands synced once at startup, only when their schema changed
+# - Aho-Corasick keyword filter over Turkish-aware normalized prompts
+# - hot-reloaded block/allow lists (JSON file and SQLite table)
+# - prompts Stability keeps filtering are refused before they cost credits
+# - short-lived negative cache for parameter combinations the API rejects
+# - shared, pooled HTTP session for Stability API calls
+# - streaming response decoding (no full JSON body in memory)
+# - binary image/png responses for single-sample requests
+# - retries with backoff/jitter for 429/5xx/connection errors
+# - coalescing of identical in-flight seeded generations
+# - on-disk LRU cache for seeded generations
 # - config via .env 
 ###
 
 import os
 import io
+import re
 import time
-import base64
 import json
+import random
+import binascii
+import math
+import multiprocessing
+import hashlib
+import functools
+import heapq
+import uuid
+import queue
 import sqlite3
+import threading
 import asyncio
+import collections
+import contextvars
+import unicodedata
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import aclosing
+from dataclasses import dataclass, field
 from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 
 import aiohttp
 import discord
 from discord import app_commands
 from discord.ext import commands
 from dotenv import load_dotenv
+from PIL import Image
 
 # Load .env
 load_dotenv()
 
+def env_flag(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
 DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
 STABILITY_API_KEY = os.getenv("STABILITY_API_KEY")
 # Default model, değiştirilebilir: örn "stable-diffusion-xl-1024-v1-0" veya "stable-diffusion-v1-5"
 DEFAULT_MODEL = os.getenv("STABILITY_MODEL", "stable-diffusion-xl-1024-v1-0")
-# Max concurrent generation
+STABILITY_API_HOST = os.getenv("STABILITY_API_HOST", "https://api.stability.ai")
+# Max concurrent generation (starting point for the adaptive limiter)
 MAX_CONCURRENT = int(os.getenv("MAX_CONCURRENT", "2"))
+# Floor / ceiling for the adaptive (AIMD) concurrency window
+CONCURRENCY_MIN = int(os.getenv("CONCURRENCY_MIN", "1"))
+CONCURRENCY_MAX = int(os.getenv("CONCURRENCY_MAX", str(MAX_CONCURRENT * 2)))
+# Window is cut when recent latency exceeds baseline by this factor, or success rate drops below the minimum
+LIMITER_LATENCY_SPIKE = float(os.getenv("LIMITER_LATENCY_SPIKE", "1.5"))
+LIMITER_MIN_SUCCESS = float(os.getenv("LIMITER_MIN_SUCCESS", "0.9"))
 # Simple per-user cooldown (seconds)
 USER_COOLDOWN = int(os.getenv("USER_COOLDOWN", "10"))
+# Hard cap on users tracked by the cooldown store
+COOLDOWN_MAX_ENTRIES = int(os.getenv("COOLDOWN_MAX_ENTRIES", "100000"))
 # Optional Guild ID to register commands faster during development (set GUILD_ID)
 GUILD_ID = os.getenv("GUILD_ID")  # optional, integer as string
+# Last synced command-schema hash per application and scope; sync is skipped while it matches
+COMMAND_SYNC_STATE = os.getenv("COMMAND_SYNC_STATE", "command_sync.json")
+# HTTP connection pool / timeouts for Stability API calls (seconds)
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv("HTTP_KEEPALIVE_TIMEOUT", "60"))
+HTTP_DNS_CACHE_TTL = int(os.getenv("HTTP_DNS_CACHE_TTL", "300"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "120"))
+HTTP_TOTAL_TIMEOUT = float(os.getenv("HTTP_TOTAL_TIMEOUT", "180"))
+# Retries for 429/5xx/connection resets (exponential backoff + jitter, honors Retry-After)
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "4"))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "1.0"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "30"))
+# Time kept in reserve (seconds) for uploading results before the interaction token expires;
+# retries, queued jobs and in-flight calls all stop this long before the deadline
+DEADLINE_MARGIN = float(os.getenv("DEADLINE_MARGIN", "60"))
+# Deterministic 400/404 answers for a parameter combination are replayed for this many seconds (0 = disabled)
+NEGATIVE_CACHE_TTL = float(os.getenv("NEGATIVE_CACHE_TTL", "300"))
+NEGATIVE_CACHE_MAX_ENTRIES = int(os.getenv("NEGATIVE_CACHE_MAX_ENTRIES", "1000"))
+# Model catalog (engines list) refresh period in seconds; each refresh clears the negative cache (0 = disabled)
+MODEL_CATALOG_REFRESH_INTERVAL = float(os.getenv("MODEL_CATALOG_REFRESH_INTERVAL", "3600"))
+# On-disk cache of seeded generations (LRU by total size, 0 = disabled)
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", "result_cache")
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+# Usage DB writes are committed in groups: every N rows or every T milliseconds
+DB_BATCH_SIZE = int(os.getenv("DB_BATCH_SIZE", "50"))
+DB_FLUSH_INTERVAL_MS = int(os.getenv("DB_FLUSH_INTERVAL_MS", "500"))
+# Number of job worker tasks pulling from the job queue
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", str(CONCURRENCY_MAX * 2)))
+# Per-guild scheduling weights for fair queuing, e.g. "123456789:2,987654321:0.5" (default weight 1)
+GUILD_WEIGHTS = {
+    int(gid): float(weight)
+    for gid, weight in (item.split(":", 1) for item in os.getenv("GUILD_WEIGHTS", "").split(",") if item.strip())
+}
+# Credit cost model: a 512x512, 30-step, 1-sample job costs 1 credit times the model factor,
+# e.g. MODEL_COST_FACTORS="stable-diffusion-xl-1024-v1-0:1.0,stable-diffusion-v1-5:0.5"
+MODEL_COST_FACTORS = {
+    name.strip(): float(factor)
+    for name, factor in (item.rsplit(":", 1) for item in os.getenv("MODEL_COST_FACTORS", "").split(",") if item.strip())
+}
+# Credit buckets per user / per guild: capacity and refill per minute (capacity 0 = unlimited)
+USER_CREDIT_CAPACITY = float(os.getenv("USER_CREDIT_CAPACITY", "50"))
+USER_CREDIT_REFILL_PER_MIN = float(os.getenv("USER_CREDIT_REFILL_PER_MIN", "10"))
+GUILD_CREDIT_CAPACITY = float(os.getenv("GUILD_CREDIT_CAPACITY", "200"))
+GUILD_CREDIT_REFILL_PER_MIN = float(os.getenv("GUILD_CREDIT_REFILL_PER_MIN", "60"))
+# Queue position / ETA edits on the deferred response (seconds between edits per job, 0 = disabled)
+PROGRESS_UPDATE_INTERVAL = float(os.getenv("PROGRESS_UPDATE_INTERVAL", "10"))
+PROGRESS_MAX_EDITS_PER_TICK = int(os.getenv("PROGRESS_MAX_EDITS_PER_TICK", "20"))
+# ETA fallback before any latency has been observed for a model
+DEFAULT_SECONDS_PER_CREDIT = float(os.getenv("DEFAULT_SECONDS_PER_CREDIT", "6"))
+# Fan samples>1 out into parallel single-sample calls and post each image as soon as it arrives
+SPLIT_SAMPLES = env_flag("SPLIT_SAMPLES", False)
+# Composite samples>1 into one grid image (Pillow, in a worker process)
+GRID_MODE = env_flag("GRID_MODE", False)
+GRID_FORMAT = os.getenv("GRID_FORMAT", "JPEG").upper()
+# lossy formats only: the grid is sized with GRID_QUALITY
+GRID_EXTENSIONS = {"JPEG": "jpg", "WEBP": "webp"}
+GRID_QUALITY = int(os.getenv("GRID_QUALITY", "90"))
+# Upload size limit used when the guild's limit is unknown (DMs), and where untouched originals are kept
+DEFAULT_UPLOAD_LIMIT = int(os.getenv("DEFAULT_UPLOAD_LIMIT", str(10 * 1024 * 1024)))
+ORIGINALS_DIR = os.getenv("ORIGINALS_DIR", "originals")
+# Originals are evicted least-recently-written once they exceed this many bytes (0 or empty dir = not kept)
+ORIGINALS_MAX_BYTES = int(os.getenv("ORIGINALS_MAX_BYTES", str(256 * 1024 * 1024)))
+# CPU worker pool: threads for response decoding, processes for Pillow work
+DECODE_THREADS = int(os.getenv("DECODE_THREADS", "2"))
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+# Tasks allowed to wait per pool before callers are held back
+WORKER_QUEUE_LIMIT = int(os.getenv("WORKER_QUEUE_LIMIT", "16"))
+# Samples buffered between the decode, encode and upload stages
+PIPELINE_BUFFER = int(os.getenv("PIPELINE_BUFFER", "1"))
+# Block/allow lists: JSON file {"block": [...], "allow": [...]} and the moderation_terms table,
+# polled every MODERATION_RELOAD_INTERVAL seconds and swapped in without a restart
+MODERATION_LISTS_PATH = os.getenv("MODERATION_LISTS_PATH", "moderation.json")
+MODERATION_RELOAD_INTERVAL = float(os.getenv("MODERATION_RELOAD_INTERVAL", "10"))
+# Prompts with this many content-filtered jobs within the window are rejected before generation (0 = disabled)
+FILTER_BLOCK_THRESHOLD = int(os.getenv("FILTER_BLOCK_THRESHOLD", "3"))
+FILTER_WINDOW_HOURS = float(os.getenv("FILTER_WINDOW_HOURS", "24"))
+FILTER_HISTORY_MAX_ENTRIES = int(os.getenv("FILTER_HISTORY_MAX_ENTRIES", "100000"))
+# Finished/failed jobs are purged from the jobs table after this many hours
+JOB_RETENTION_HOURS = float(os.getenv("JOB_RETENTION_HOURS", "24"))
+# On shutdown, running jobs get this many seconds to finish before they are cut off
+SHUTDOWN_GRACE = float(os.getenv("SHUTDOWN_GRACE", "30"))
+# Log a metrics snapshot every N seconds (0 = disabled)
+METRICS_LOG_INTERVAL = float(os.getenv("METRICS_LOG_INTERVAL", "300"))
 
 if not DISCORD_TOKEN or not STABILITY_API_KEY:
     raise SystemExit("DISCORD_TOKEN and STABILITY_API_KEY must be set in environment variables (.env).")
+if GRID_FORMAT not in GRID_EXTENSIONS:
+    raise SystemExit(f"GRID_FORMAT must be one of {', '.join(GRID_EXTENSIONS)} (got {GRID_FORMAT!r}).")
+
+# Shared HTTP session (created in setup_hook, closed on shutdown)
+http_session: aiohttp.ClientSession | None = None
+
+def make_http_session() -> aiohttp.ClientSession:
+    """
+    Builds the long-lived session used for every Stability API call.
+    Keep-alive + DNS cache avoid a fresh TCP/TLS handshake per /resim,
+    and the per-host limit matches the concurrency ceiling.
+    """
+    connector = aiohttp.TCPConnector(
+        limit=max(10, CONCURRENCY_MAX * 2),
+        limit_per_host=CONCURRENCY_MAX,
+        ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+        keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+    )
+    timeout = aiohttp.ClientTimeout(
+        total=HTTP_TOTAL_TIMEOUT,
+        connect=HTTP_CONNECT_TIMEOUT,
+        sock_connect=HTTP_CONNECT_TIMEOUT,
+        sock_read=HTTP_READ_TIMEOUT,
+    )
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+def get_http_session() -> aiohttp.ClientSession:
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = make_http_session()
+    return http_session
+
+class Metrics:
+    """
+    Tiny in-process metrics registry: counters, gauges and timing summaries.
+    A snapshot is printed every METRICS_LOG_INTERVAL seconds.
+    """
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.timings = {}  # name -> [count, total, max]
+
+    def inc(self, name: str, value: float = 1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def set_gauge(self, name: str, value: float):
+        self.gauges[name] = value
+
+    def observe(self, name: str, seconds: float):
+        t = self.timings.get(name)
+        if t is None:
+            self.timings[name] = [1, seconds, seconds]
+        else:
+            t[0] += 1
+            t[1] += seconds
+            t[2] = max(t[2], seconds)
+
+    def snapshot(self) -> dict:
+        timings = {name: {"count": c, "avg": round(total / c, 4), "max": round(mx, 4)}
+                   for name, (c, total, mx) in self.timings.items()}
+        return {"counters": dict(self.counters), "gauges": dict(self.gauges), "timings": timings}
+
+metrics = Metrics()
+
+async def metrics_log_loop():
+    while True:
+        await asyncio.sleep(METRICS_LOG_INTERVAL)
+        print("metrics " + json.dumps(metrics.snapshot(), sort_keys=True))
+
+class AdaptiveLimiter:
+    """
+    AIMD concurrency limiter with the same acquire()/release() shape as a semaphore.
+    Outcomes are reported through record(): the window grows by about one slot per
+    window of successful calls with stable latency, and is cut multiplicatively on
+    429s, latency spikes or a falling success rate. It stays within [floor, ceiling].
+    """
+    THROTTLE_BACKOFF = 0.5
+    LATENCY_BACKOFF = 0.75
+    DECREASE_INTERVAL = 5.0  # seconds between two cuts, so one burst of 429s counts once
+
+    def __init__(self, initial: int, floor: int, ceiling: int, name: str = "limiter"):
+        self.floor = max(1, floor)
+        self.ceiling = max(self.floor, ceiling)
+        self.name = name
+        self.in_flight = 0
+        self._limit = float(min(max(initial, self.floor), self.ceiling))
+        self._waiters = collections.deque()
+        self._baseline = None  # slow EWMA of normalized latency
+        self._recent = None    # fast EWMA of normalized latency
+        self._success = 1.0    # EWMA of success rate
+        self._last_decrease = 0.0
+        self._publish()
+
+    @property
+    def limit(self) -> int:
+        return max(self.floor, int(self._limit))
+
+    async def acquire(self):
+        if not self._waiters and self.in_flight < self.limit:
+            self.in_flight += 1
+            self._publish()
+            return
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # a slot was handed over just before the cancel: give it back
+                self.release()
+            raise
+
+    def release(self):
+        self.in_flight -= 1
+        self._wake()
+        self._publish()
+
+    def record(self, outcome: str, latency: float | None = None):
+        """outcome: 'ok', 'throttled' (429) or 'error'; latency normalized by request size."""
+        ok = outcome == "ok"
+        self._success = self._success * 0.9 + (0.1 if ok else 0.0)
+        if outcome == "throttled":
+            self._decrease(self.THROTTLE_BACKOFF)
+            return
+        if not ok:
+            if self._success < LIMITER_MIN_SUCCESS:
+                self._decrease(self.LATENCY_BACKOFF)
+            return
+        if latency is not None:
+            self._recent = latency if self._recent is None else self._recent * 0.7 + latency * 0.3
+            self._baseline = latency if self._baseline is None else self._baseline * 0.95 + latency * 0.05
+            if self._recent > self._baseline * LIMITER_LATENCY_SPIKE:
+                self._decrease(self.LATENCY_BACKOFF)
+                return
+        # only grow while the window is actually used
+        if self._success >= LIMITER_MIN_SUCCESS and (self._waiters or self.in_flight >= self.limit):
+            self._limit = min(float(self.ceiling), self._limit + 1.0 / self._limit)
+            self._wake()
+            self._publish()
+
+    def _decrease(self, factor: float):
+        now = time.monotonic()
+        if now - self._last_decrease < self.DECREASE_INTERVAL:
+            return
+        self._last_decrease = now
+        self._limit = max(float(self.floor), self._limit * factor)
+        metrics.inc(f"{self.name}.decreases")
+        self._publish()
+
+    def _wake(self):
+        while self._waiters and self.in_flight < self.limit:
+            fut = self._waiters.popleft()
+            if fut.done():
+                continue
+            self.in_flight += 1
+            fut.set_result(None)
+
+    def _publish(self):
+        metrics.set_gauge(f"{self.name}.limit", self.limit)
+        metrics.set_gauge(f"{self.name}.in_flight", self.in_flight)
+        metrics.set_gauge(f"{self.name}.waiting", len(self._waiters))
 
 # Concurrency control
-generation_semaphore = asyncio.Semaphore(MAX_CONCURRENT)
+generation_limiter = AdaptiveLimiter(MAX_CONCURRENT, CONCURRENCY_MIN, CONCURRENCY_MAX, name="generation_limiter")
+
+class ReservedSlot:
+    """
+    A limiter slot a job worker acquired before taking its job. The job's first
+    upstream call claims it instead of queueing in the limiter again; release()
+    returns it if nothing claimed it.
+    """
+    def __init__(self, limiter: AdaptiveLimiter):
+        self.limiter = limiter
+        self.held = True
+
+    def claim(self) -> bool:
+        held, self.held = self.held, False
+        return held
+
+    def release(self):
+        if self.claim():
+            self.limiter.release()
+
+# set by job_worker for the job it runs; copied into the tasks the job spawns
+reserved_slot: contextvars.ContextVar[ReservedSlot | None] = contextvars.ContextVar("reserved_slot", default=None)
+
+class CooldownStore:
+    """
+    Per-user cooldown that forgets users once their cooldown has passed.
+    Every entry has the same duration, so insertion order is expiry order: the
+    OrderedDict is swept from the front on each access (amortized O(1) check and
+    update) and capped at `max_entries` by dropping the entries expiring soonest.
+    """
+    def __init__(self, cooldown: float, max_entries: int):
+        self.cooldown = cooldown
+        self.max_entries = max(1, max_entries)
+        self._expires = collections.OrderedDict()  # user_id -> expiry (monotonic), soonest first
+
+    def _sweep(self, now: float):
+        while self._expires:
+            user_id, expiry = next(iter(self._expires.items()))
+            if expiry > now:
+                break
+            del self._expires[user_id]
+        metrics.set_gauge("cooldown.active", len(self._expires))
+
+    def remaining(self, user_id: int) -> float:
+        now = time.monotonic()
+        self._sweep(now)
+        expiry = self._expires.get(user_id)
+        return 0.0 if expiry is None else expiry - now
+
+    def start(self, user_id: int):
+        now = time.monotonic()
+        self._expires.pop(user_id, None)
+        self._expires[user_id] = now + self.cooldown
+        while len(self._expires) > self.max_entries:
+            self._expires.popitem(last=False)
+            metrics.inc("cooldown.evicted")
+        self._sweep(now)
+
+def estimate_cost(model: str, width: int, height: int, steps: int, samples: int) -> float:
+    """Credits for one request: pixels x steps x samples relative to 512x512/30 steps, times the model factor."""
+    units = (width * height * steps * samples) / (512 * 512 * 30)
+    return round(units * MODEL_COST_FACTORS.get(model, 1.0), 3)
+
+class CreditBuckets:
+    """
+    Token buckets of credits keyed by user or guild id, refilled continuously.
+    Buckets that have refilled to capacity hold no information and are pruned.
+    """
+    def __init__(self, capacity: float, refill_per_min: float, name: str):
+        self.capacity = capacity
+        self.rate = refill_per_min / 60.0
+        self.name = name
+        self._buckets = {}  # key -> (credits, last update monotonic)
+
+    @property
+    def enabled(self) -> bool:
+        return self.capacity > 0
+
+    def available(self, key) -> float:
+        if not self.enabled:
+            return float("inf")
+        credits, last = self._buckets.get(key, (self.capacity, time.monotonic()))
+        return min(self.capacity, credits + (time.monotonic() - last) * self.rate)
+
+    def wait_time(self, key, cost: float) -> float:
+        """Seconds until `cost` credits are available (inf if it exceeds the capacity)."""
+        missing = cost - self.available(key)
+        if missing <= 0:
+            return 0.0
+        if cost > self.capacity or self.rate <= 0:
+            return float("inf")
+        return missing / self.rate
+
+    def take(self, key, cost: float):
+        if not self.enabled:
+            return
+        self._buckets[key] = (self.available(key) - cost, time.monotonic())
+        if len(self._buckets) > 10000:
+            self._prune()
+        metrics.set_gauge(f"{self.name}.buckets", len(self._buckets))
+
+    def refund(self, key, cost: float):
+        if not self.enabled:
+            return
+        self._buckets[key] = (min(self.capacity, self.available(key) + cost), time.monotonic())
+
+    def _prune(self):
+        for key in [k for k in self._buckets if self.available(k) >= self.capacity]:
+            del self._buckets[key]
+
+class LatencyEstimator:
+    """
+    Rolling (EWMA) generation latency per model, keyed by pixel count and steps.
+    Unseen sizes fall back to the model's seconds-per-credit rate, then to
+    DEFAULT_SECONDS_PER_CREDIT.
+    """
+    ALPHA = 0.2
+
+    def __init__(self, default_seconds_per_credit: float):
+        self.default_rate = default_seconds_per_credit
+        self._exact = {}  # (model, pixels, steps) -> seconds per sample
+        self._rate = {}   # model -> seconds per credit
+
+    def _ewma(self, table: dict, key, value: float):
+        old = table.get(key)
+        table[key] = value if old is None else old + self.ALPHA * (value - old)
+
+    def record(self, model: str, width: int, height: int, steps: int, samples: int, seconds: float):
+        samples = max(1, samples)
+        self._ewma(self._exact, (model, width * height, steps), seconds / samples)
+        cost = estimate_cost(model, width, height, steps, samples)
+        if cost > 0:
+            self._ewma(self._rate, model, seconds / cost)
+
+    def estimate(self, model: str, width: int, height: int, steps: int, samples: int) -> float:
+        per_sample = self._exact.get((model, width * height, steps))
+        if per_sample is not None:
+            return per_sample * max(1, samples)
+        return self._rate.get(model, self.default_rate) * estimate_cost(model, width, height, steps, samples)
+
+generation_latency = LatencyEstimator(DEFAULT_SECONDS_PER_CREDIT)
+
+user_credits = CreditBuckets(USER_CREDIT_CAPACITY, USER_CREDIT_REFILL_PER_MIN, "credits.user")
+guild_credits = CreditBuckets(GUILD_CREDIT_CAPACITY, GUILD_CREDIT_REFILL_PER_MIN, "credits.guild")
+
+def admit_credits(user_id: int, guild_id: int | None, cost: float) -> float:
+    """Takes `cost` from the user's and guild's buckets; returns 0, or the seconds to wait when over budget."""
+    wait = user_credits.wait_time(user_id, cost)
+    if guild_id:
+        wait = max(wait, guild_credits.wait_time(guild_id, cost))
+    if wait > 0:
+        metrics.inc("credits.rejected")
+        return wait
+    user_credits.take(user_id, cost)
+    if guild_id:
+        guild_credits.take(guild_id, cost)
+    metrics.inc("credits.spent", cost)
+    return 0.0
+
+def refund_credits(user_id: int, guild_id: int | None, cost: float):
+    user_credits.refund(user_id, cost)
+    if guild_id:
+        guild_credits.refund(guild_id, cost)
+    metrics.inc("credits.refunded", cost)
+
+class WorkerPool:
+    """
+    Bounded CPU executors kept off the event loop: a thread pool for response
+    decoding and a process pool for Pillow work. The process pool forks its
+    workers, so start() must run before any other thread exists; forking a
+    multi-threaded process can copy locks held by threads that are not copied.
+    At most `queue_limit` tasks per pool are submitted beyond its workers; further
+    callers wait. Queue depth and per-task timing are exported as metrics.
+    """
+    def __init__(self, threads: int, processes: int, queue_limit: int):
+        self.threads = max(1, threads)
+        self.processes = max(1, processes)
+        self._thread_pool = None
+        self._process_pool = None
+        self._slots = {
+            "thread": asyncio.Semaphore(self.threads + queue_limit),
+            "process": asyncio.Semaphore(self.processes + queue_limit),
+        }
+        self._pending = {"thread": 0, "process": 0}
+
+    async def run_thread(self, fn, *args):
+        """Runs fn(*args) in the decode thread pool."""
+        if self._thread_pool is None:
+            self._thread_pool = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="decode")
+        return await self._run("thread", self._thread_pool, fn, args)
+
+    def start(self):
+        """
+        Creates the process pool and forks all of its workers right away. Re-importing
+        this module runs the schema DDL, so spawn/forkserver are not an option here.
+        """
+        if self._process_pool is not None:
+            return
+        context = multiprocessing.get_context("fork") if "fork" in multiprocessing.get_all_start_methods() else None
+        self._process_pool = ProcessPoolExecutor(max_workers=self.processes, mp_context=context)
+        # with fork, the first submit launches every worker before the manager thread starts
+        self._process_pool.submit(os.getpid).result()
+
+    async def run_process(self, fn, *args):
+        """Runs a picklable, module-level fn(*args) in the image process pool."""
+        self.start()
+        return await self._run("process", self._process_pool, fn, args)
+
+    async def _run(self, kind: str, executor, fn, args):
+        self._pending[kind] += 1
+        metrics.set_gauge(f"worker_pool.{kind}.queue_depth", self._pending[kind])
+        try:
+            async with self._slots[kind]:
+                started = time.monotonic()
+                result = await asyncio.get_running_loop().run_in_executor(executor, functools.partial(fn, *args))
+                metrics.observe(f"worker_pool.{kind}.{fn.__name__}", time.monotonic() - started)
+                return result
+        finally:
+            self._pending[kind] -= 1
+            metrics.set_gauge(f"worker_pool.{kind}.queue_depth", self._pending[kind])
+
+    def shutdown(self):
+        if self._thread_pool is not None:
+            self._thread_pool.shutdown(wait=False, cancel_futures=True)
+        if self._process_pool is not None:
+            self._process_pool.shutdown(wait=False, cancel_futures=True)
+
+cpu_pool = WorkerPool(DECODE_THREADS, IMAGE_WORKERS, WORKER_QUEUE_LIMIT)
+
+def compose_grid(images: list[bytes], fmt: str, quality: int) -> bytes:
+    """
+    Pastes the images into a near-square grid (left to right, top to bottom) and
+    encodes it as `fmt`. Runs in a worker process.
+    """
+    tiles = [Image.open(io.BytesIO(data)).convert("RGB") for data in images]
+    tile_w = max(t.width for t in tiles)
+    tile_h = max(t.height for t in tiles)
+    cols = math.ceil(math.sqrt(len(tiles)))
+    rows = math.ceil(len(tiles) / cols)
+    grid = Image.new("RGB", (cols * tile_w, rows * tile_h))
+    for i, tile in enumerate(tiles):
+        grid.paste(tile, ((i % cols) * tile_w, (i // cols) * tile_h))
+    out = io.BytesIO()
+    grid.save(out, format=fmt, quality=quality)
+    return out.getvalue()
+
+def fit_image(data: bytes, budget: int) -> tuple[bytes, str] | None:
+    """
+    Makes an image fit in `budget` bytes: WebP, then JPEG at decreasing quality,
+    then the same at 75% of the size each round. Returns (bytes, extension), or
+    None when the image already fits. Runs in a worker process.
+    """
+    if len(data) <= budget:
+        return None
+    img = Image.open(io.BytesIO(data)).convert("RGB")
+    best = None
+    scale = 1.0
+    while scale > 0.1:
+        frame = img if scale == 1.0 else img.resize((max(1, int(img.width * scale)), max(1, int(img.height * scale))), Image.LANCZOS)
+        for fmt, quality in (("WEBP", 90), ("WEBP", 75), ("JPEG", 85), ("JPEG", 70)):
+            out = io.BytesIO()
+            frame.save(out, format=fmt, quality=quality)
+            encoded = (out.getvalue(), "webp" if fmt == "WEBP" else "jpg")
+            if best is None or len(encoded[0]) < len(best[0]):
+                best = encoded
+            if len(encoded[0]) <= budget:
+                return encoded
+        scale *= 0.75
+    return best
+
+class DiskLRU:
+    """
+    Files in one directory, indexed in memory and evicted least-recently-used once
+    their total size passes `max_bytes`. The index is only touched from the event
+    loop; file I/O runs in threads. Subclasses choose the file suffix and metric prefix.
+    """
+    SUFFIX = ""
+    METRIC = "disk_lru"
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._index = collections.OrderedDict()  # key -> size, oldest first
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory) and self.max_bytes > 0
+
+    def __contains__(self, key: str) -> bool:
+        return self.enabled and key in self._index
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + self.SUFFIX)
+
+    def _tmp_path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.{os.getpid()}.{random.getrandbits(32):08x}.tmp")
+
+    def load(self):
+        """Rebuilds the LRU index from the files on disk (blocking, call at startup)."""
+        if not self.enabled:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".tmp"):
+                os.unlink(entry.path)  # leftover of an interrupted write
+            elif entry.name.endswith(self.SUFFIX) and entry.is_file():
+                st = entry.stat()
+                entries.append((st.st_mtime, entry.name[:len(entry.name) - len(self.SUFFIX)], st.st_size))
+        self._index.clear()
+        self.total_bytes = 0
+        for _, key, size in sorted(entries):
+            self._index[key] = size
+            self.total_bytes += size
+        metrics.set_gauge(f"{self.METRIC}.bytes", self.total_bytes)
+
+    async def _admit(self, key: str, size: int):
+        """Indexes a freshly written file and evicts the oldest ones past the byte cap."""
+        self._forget(key)
+        self._index[key] = size
+        self.total_bytes += size
+        victims = []
+        while self.total_bytes > self.max_bytes and len(self._index) > 1:
+            old_key, old_size = self._index.popitem(last=False)
+            self.total_bytes -= old_size
+            victims.append(old_key)
+        metrics.set_gauge(f"{self.METRIC}.bytes", self.total_bytes)
+        if victims:
+            metrics.inc(f"{self.METRIC}.evictions", len(victims))
+            await asyncio.to_thread(self._unlink, victims)
+
+    def _forget(self, key: str):
+        size = self._index.pop(key, None)
+        if size is not None:
+            self.total_bytes -= size
+
+    def _unlink(self, keys: list[str]):
+        for key in keys:
+            try:
+                os.unlink(self._path(key))
+            except FileNotFoundError:
+                pass
+
+class OriginalsStore(DiskLRU):
+    """Untouched images whose uploaded copy had to be re-encoded, capped by total size."""
+    METRIC = "originals"
+
+    async def put(self, name: str, data: bytes):
+        if not self.enabled:
+            return
+        size = await asyncio.to_thread(self._write, name, data)
+        await self._admit(name, size)
+
+    def _write(self, name: str, data: bytes) -> int:
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = self._tmp_path(name)
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, self._path(name))
+        return len(data)
+
+originals = OriginalsStore(ORIGINALS_DIR, ORIGINALS_MAX_BYTES)
+
+async def fit_for_upload(data: bytes, budget: int, name: str) -> tuple[bytes, str | None]:
+    """Returns (bytes to upload, new extension or None if unchanged), re-encoding in the process pool when too large."""
+    if len(data) <= budget:
+        return data, None
+    fitted = await cpu_pool.run_process(fit_image, data, budget)
+    if fitted is None:
+        return data, None
+    metrics.inc("upload_fit.fallbacks")
+    metrics.inc("upload_fit.bytes_saved", len(data) - len(fitted[0]))
+    try:
+        await originals.put(name, data)
+    except OSError as e:
+        print(f"Could not keep original {name}: {e}")
+    return fitted
 
 # Cooldown tracking
-last_request = {}  # user_id -> timestamp
+cooldowns = CooldownStore(USER_COOLDOWN, COOLDOWN_MAX_ENTRIES)
 
 # Create/Connect to sqlite DB for logs
 DB_PATH = os.getenv("USAGE_DB_PATH", "usage.db")
 conn = sqlite3.connect(DB_PATH)
 cursor = conn.cursor()
+cursor.execute("PRAGMA journal_mode=WAL")
 cursor.execute("""
 CREATE TABLE IF NOT EXISTS usages (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -68,10 +744,171 @@ CREATE TABLE IF NOT EXISTS usages (
     timestamp TEXT
 )
 """)
+cursor.execute("""
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    state TEXT,
+    user_id TEXT,
+    username TEXT,
+    guild_id TEXT,
+    application_id TEXT,
+    interaction_token TEXT,
+    token_expires_at REAL,
+    params TEXT,
+    error TEXT,
+    created_at REAL,
+    updated_at REAL,
+    upload_limit INTEGER
+)
+""")
+if "upload_limit" not in [row[1] for row in cursor.execute("PRAGMA table_info(jobs)")]:
+    cursor.execute("ALTER TABLE jobs ADD COLUMN upload_limit INTEGER")
+cursor.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state)")
+cursor.execute("""
+CREATE TABLE IF NOT EXISTS prompt_filter_events (
+    prompt_hash TEXT,
+    filtered_at REAL
+)
+""")
+cursor.execute("CREATE INDEX IF NOT EXISTS prompt_filter_events_hash ON prompt_filter_events (prompt_hash, filtered_at)")
+cursor.execute("""
+CREATE TABLE IF NOT EXISTS moderation_terms (
+    kind TEXT CHECK (kind IN ('block', 'allow')),
+    term TEXT,
+    PRIMARY KEY (kind, term)
+)
+""")
 conn.commit()
 
+class SQLiteWriter(threading.Thread):
+    """
+    Dedicated writer thread so the event loop never waits for an fsync.
+    Statements are queued with execute() and committed in groups of up to
+    `batch_size` rows, or after `flush_interval` seconds, on the thread's own
+    WAL-mode connection (synchronous=NORMAL). stop() flushes what is left.
+    """
+    _STOP = object()
+
+    def __init__(self, path: str, batch_size: int, flush_interval: float):
+        super().__init__(name="sqlite-writer", daemon=True)
+        self.path = path
+        self.batch_size = max(1, batch_size)
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue()
+
+    def execute(self, sql: str, params: tuple = ()):
+        self._queue.put((sql, params))
+        metrics.set_gauge("db_writer.queue_depth", self._queue.qsize())
+
+    def stop(self, timeout: float = 10.0):
+        self._queue.put(self._STOP)
+        if self.is_alive():
+            self.join(timeout)
+
+    def run(self):
+        db = sqlite3.connect(self.path)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is self._STOP:
+                break
+            batch = [item]
+            flush_at = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = flush_at - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._commit(db, batch)
+        # flush anything queued after the stop marker
+        rest = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not self._STOP:
+                rest.append(item)
+        if rest:
+            self._commit(db, rest)
+        db.close()
+
+    def _commit(self, db: sqlite3.Connection, batch: list):
+        started = time.monotonic()
+        for sql, params in batch:
+            try:
+                db.execute(sql, params)
+            except sqlite3.Error as e:
+                print(f"DB write failed: {e}")
+        try:
+            db.commit()
+        except sqlite3.Error as e:
+            print(f"DB commit failed: {e}")
+        metrics.observe("db_writer.commit", time.monotonic() - started)
+        metrics.inc("db_writer.rows", len(batch))
+        metrics.set_gauge("db_writer.queue_depth", self._queue.qsize())
+
+db_writer = SQLiteWriter(DB_PATH, DB_BATCH_SIZE, DB_FLUSH_INTERVAL_MS / 1000)
+
+class StabilityBot(commands.Bot):
+    async def setup_hook(self):
+        get_http_session()
+        db_writer.start()
+        await asyncio.to_thread(result_cache.load)
+        await asyncio.to_thread(originals.load)
+        await asyncio.to_thread(reload_moderation_lists)
+        await asyncio.to_thread(filter_history.load, DB_PATH)
+        self.background_tasks = []
+        pending, dropped = await asyncio.to_thread(job_queue.load_pending, DEADLINE_MARGIN)
+        job_queue.resume(pending, dropped)
+        if dropped:
+            self.background_tasks.append(asyncio.create_task(notify_dropped_jobs(dropped)))
+        self.job_workers = [asyncio.create_task(job_worker()) for _ in range(max(1, JOB_WORKERS))]
+        if PROGRESS_UPDATE_INTERVAL > 0:
+            self.background_tasks.append(asyncio.create_task(progress_update_loop()))
+        if METRICS_LOG_INTERVAL > 0:
+            self.background_tasks.append(asyncio.create_task(metrics_log_loop()))
+        if MODERATION_RELOAD_INTERVAL > 0:
+            self.background_tasks.append(asyncio.create_task(moderation_watch_loop()))
+        if MODEL_CATALOG_REFRESH_INTERVAL > 0:
+            self.background_tasks.append(asyncio.create_task(model_catalog_loop()))
+        # one-shot: on_ready fires again after every gateway reconnect, this does not
+        self.background_tasks.append(asyncio.create_task(sync_commands_task()))
+
+    async def close(self):
+        # stop dispatching and let running jobs finish (bounded) while Discord and the DB writer are still up;
+        # queued jobs stay in the table and are resumed on the next start
+        job_queue.closed = True
+        workers = getattr(self, "job_workers", [])
+        for task in workers:
+            if task not in busy_workers:
+                task.cancel()
+        busy = [task for task in workers if task in busy_workers]
+        if busy:
+            print(f"Shutdown: waiting up to {SHUTDOWN_GRACE:g}s for {len(busy)} running job(s)")
+            _, still_running = await asyncio.wait(busy, timeout=SHUTDOWN_GRACE)
+            for task in still_running:
+                task.cancel()  # left as running in the table; its user is told on the next start
+            await asyncio.gather(*still_running, return_exceptions=True)
+        for task in getattr(self, "background_tasks", []):
+            task.cancel()
+        await super().close()
+        await asyncio.to_thread(db_writer.stop)
+        cpu_pool.shutdown()
+        if http_session is not None and not http_session.closed:
+            await http_session.close()
+
 intents = discord.Intents.default()
-bot = commands.Bot(command_prefix="!", intents=intents)
+bot = StabilityBot(command_prefix="!", intents=intents)
 
 # For slash commands
 tree = bot.tree
@@ -81,14 +918,616 @@ BANNED_KEYWORDS = [
     # Don't include explicit items here; instead keep this as a placeholder for admin to expand.
     # For example you may add "child", "illegal-drug", etc. in production.
 ]
-def prompt_blocked(prompt: str) -> bool:
-    p = prompt.lower()
-    for w in BANNED_KEYWORDS:
-        if w in p:
-            return True
-    return False
 
-async def call_stability_generate(prompt: str,
+# Turkish dotted/dotless i first (str.lower() maps "I" to "i" but "İ" to "i̇"), then
+# letters that have no Unicode decomposition, then common leetspeak substitutions.
+_FOLD_TABLE = str.maketrans({
+    "İ": "i", "I": "i", "ı": "i",
+    "ø": "o", "ł": "l", "đ": "d", "ð": "d", "þ": "th", "æ": "ae", "œ": "oe",
+    "0": "o", "1": "i", "3": "e", "4": "a", "5": "s", "7": "t", "@": "a", "$": "s", "!": "i", "|": "l",
+})
+_WHITESPACE = re.compile(r"\s+")
+
+def normalize_text(text: str) -> str:
+    """Folds text for keyword matching: Turkish-aware casefold, NFKC, diacritics and leetspeak."""
+    text = unicodedata.normalize("NFKC", text).translate(_FOLD_TABLE).casefold().translate(_FOLD_TABLE)
+    text = "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c))
+    return _WHITESPACE.sub(" ", text)
+
+class KeywordMatcher:
+    """
+    Aho-Corasick automaton over normalized terms: one pass over the text finds every
+    term, independent of how many terms there are. Immutable once built; callers
+    swap in a new instance instead of mutating it.
+    """
+
+    def __init__(self, terms):
+        self.goto = [{}]    # node -> {char: node}
+        self.fail = [0]
+        self.output = [None]  # term ending exactly at this node
+        self.link = [0]     # nearest node on the fail chain with an output (0 = none)
+        self.depth = [0]
+        for term in terms:
+            key = normalize_text(term).strip()
+            if not key:
+                continue
+            node = 0
+            for ch in key:
+                nxt = self.goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[node][ch] = nxt
+                    self.goto.append({}); self.fail.append(0); self.output.append(None); self.link.append(0)
+                    self.depth.append(self.depth[node] + 1)
+                node = nxt
+            if self.output[node] is None:
+                self.output[node] = term
+        self.size = sum(1 for o in self.output if o is not None)
+        # breadth-first so every fail target is finished before its dependants
+        pending = collections.deque(self.goto[0].values())
+        while pending:
+            node = pending.popleft()
+            for ch, nxt in self.goto[node].items():
+                f = self.fail[node]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                target = self.goto[f].get(ch, 0)
+                self.fail[nxt] = target if target != nxt else 0
+                self.link[nxt] = target if self.output[target] is not None else self.link[target]
+                pending.append(nxt)
+
+    def iter_matches(self, text: str):
+        """Yields (start, end, term) for every occurrence in already-normalized text."""
+        goto, fail, output, link, depth = self.goto, self.fail, self.output, self.link, self.depth
+        node = 0
+        for i, ch in enumerate(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            hit = node if output[node] is not None else link[node]
+            while hit:
+                yield i + 1 - depth[hit], i + 1, output[hit]
+                hit = link[hit]
+
+    def find(self, text: str) -> str | None:
+        """First term found in `text` (normalized here), or None."""
+        if not self.size:
+            return None
+        for _, _, term in self.iter_matches(normalize_text(text)):
+            return term
+        return None
+
+class ModerationLists:
+    """
+    Immutable snapshot of the compiled block and allow lists. A blocked term is
+    ignored when it lies entirely inside an allowlisted span (e.g. an allowed
+    phrase that happens to contain a blocked word).
+    """
+
+    def __init__(self, version: int, block_terms, allow_terms):
+        self.version = version
+        self.blocklist = KeywordMatcher(block_terms)
+        self.allowlist = KeywordMatcher(allow_terms)
+
+    def find(self, text: str) -> str | None:
+        if not self.blocklist.size:
+            return None
+        text = normalize_text(text)
+        allowed = [(a, b) for a, b, _ in self.allowlist.iter_matches(text)] if self.allowlist.size else []
+        for start, end, term in self.blocklist.iter_matches(text):
+            if not any(a <= start and end <= b for a, b in allowed):
+                return term
+        return None
+
+# rebuilt and rebound as a whole, so readers never see a half-built automaton and need no lock
+moderation = ModerationLists(0, BANNED_KEYWORDS, [])
+
+def set_moderation_lists(block_terms, allow_terms=()):
+    global moderation
+    moderation = ModerationLists(moderation.version + 1, block_terms, allow_terms)
+    return moderation
+
+class ModerationSource:
+    """
+    Reads BANNED_KEYWORDS plus the MODERATION_LISTS_PATH file and the moderation_terms
+    table. poll() is blocking and returns (block, allow) only when something changed:
+    the file's mtime/size, or the table contents after another connection committed.
+    The two sources fail independently: a broken file keeps its last good terms
+    (and is reported once per version of the file) while table changes still apply.
+    """
+
+    def __init__(self, path: str, db_path: str):
+        self.path = path
+        self.db = sqlite3.connect(db_path, check_same_thread=False)  # only used from one poll at a time
+        self.file_stamp = None
+        self.file_terms = ([], [])
+        self.db_version = None
+        self.db_terms = ([], [])
+
+    def _read_file(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            stamp, terms = None, ([], [])
+        else:
+            stamp = (st.st_mtime_ns, st.st_size)
+            if stamp == self.file_stamp:
+                return False
+            try:
+                terms = self._parse_file()
+            except (OSError, ValueError) as e:
+                self.file_stamp = stamp  # not retried until the file changes again
+                print(f"Moderation file {self.path} not loaded, keeping its previous terms: {e}")
+                return False
+        changed = stamp != self.file_stamp
+        self.file_stamp, self.file_terms = stamp, terms
+        return changed
+
+    def _parse_file(self) -> tuple[list[str], list[str]]:
+        with open(self.path, encoding="utf-8") as f:
+            data = json.load(f)
+        if not isinstance(data, dict) or not all(isinstance(data.get(k, []), list) for k in ("block", "allow")):
+            raise ValueError('expected {"block": [...], "allow": [...]}')
+        return [str(t) for t in data.get("block", [])], [str(t) for t in data.get("allow", [])]
+
+    def _read_db(self):
+        version = self.db.execute("PRAGMA data_version").fetchone()[0]
+        if version == self.db_version:
+            return False
+        self.db_version = version
+        rows = self.db.execute("SELECT kind, term FROM moderation_terms ORDER BY kind, term").fetchall()
+        terms = ([t for k, t in rows if k == "block"], [t for k, t in rows if k == "allow"])
+        changed = terms != self.db_terms
+        self.db_terms = terms
+        return changed
+
+    def poll(self):
+        changed = self._read_file()
+        try:
+            changed = self._read_db() or changed
+        except sqlite3.Error as e:
+            print(f"Moderation table not read, keeping its previous terms: {e}")
+        if not changed:
+            return None
+        block = [*BANNED_KEYWORDS, *self.file_terms[0], *self.db_terms[0]]
+        allow = [*self.file_terms[1], *self.db_terms[1]]
+        return block, allow
+
+moderation_source = ModerationSource(MODERATION_LISTS_PATH, DB_PATH)
+
+def reload_moderation_lists() -> ModerationLists | None:
+    """Blocking: rebuilds and swaps in the lists if their sources changed."""
+    try:
+        lists = moderation_source.poll()
+    except OSError as e:
+        print(f"Moderation lists not reloaded, keeping v{moderation.version}: {e}")
+        return None
+    if lists is None:
+        return None
+    started = time.monotonic()
+    snapshot = set_moderation_lists(*lists)
+    metrics.inc("moderation.reloads")
+    print(f"Moderation lists v{snapshot.version}: {snapshot.blocklist.size} blocked, "
+          f"{snapshot.allowlist.size} allowed terms ({time.monotonic() - started:.2f}s)")
+    return snapshot
+
+async def moderation_watch_loop():
+    while True:
+        await asyncio.sleep(MODERATION_RELOAD_INTERVAL)
+        await asyncio.to_thread(reload_moderation_lists)
+
+def find_blocked_term(prompt: str) -> str | None:
+    """The blocklist term the prompt contains, for the audit log."""
+    return moderation.find(prompt)
+
+class FilterHistory:
+    """
+    Learned pre-block list: remembers when jobs for a normalized prompt came back
+    caught by Stability's content filter (one event per job, however many of its
+    samples were filtered). A prompt with `threshold` such jobs within the last
+    `window` seconds is refused before any credits are spent; older events age out.
+    Kept in memory (least recently filtered prompts evicted past `max_entries`)
+    and mirrored to prompt_filter_events through db_writer.
+    """
+
+    def __init__(self, threshold: int, window: float, max_entries: int):
+        self.threshold = threshold
+        self.window = window
+        self.max_entries = max(1, max_entries)
+        # prompt hash -> wall-clock times of its most recent filtered jobs (only the last `threshold` matter)
+        self._events = collections.OrderedDict()
+
+    @staticmethod
+    def key(prompt: str) -> str:
+        return hashlib.sha256(normalize_text(prompt).strip().encode()).hexdigest()
+
+    def count(self, prompt: str) -> int:
+        """Filtered jobs for the prompt within the window."""
+        cutoff = time.time() - self.window
+        return sum(1 for t in self._events.get(self.key(prompt), ()) if t >= cutoff)
+
+    def blocked(self, prompt: str) -> bool:
+        return self.threshold > 0 and self.count(prompt) >= self.threshold
+
+    def record(self, prompt: str):
+        if self.threshold <= 0:
+            return
+        key, now = self.key(prompt), time.time()
+        events = self._events.pop(key, None) or collections.deque(maxlen=self.threshold)
+        events.append(now)
+        self._events[key] = events
+        while len(self._events) > self.max_entries:
+            self._events.popitem(last=False)
+        db_writer.execute("INSERT INTO prompt_filter_events (prompt_hash, filtered_at) VALUES (?, ?)", (key, now))
+        db_writer.execute("DELETE FROM prompt_filter_events WHERE prompt_hash = ? AND filtered_at < ?", (key, now - self.window))
+        metrics.set_gauge("prefilter.entries", len(self._events))
+
+    def load(self, path: str):
+        """Blocking, called once at startup: restores the events still inside the window."""
+        cutoff = time.time() - self.window
+        db = sqlite3.connect(path)
+        try:
+            db.execute("DELETE FROM prompt_filter_events WHERE filtered_at < ?", (cutoff,))
+            db.commit()
+            rows = db.execute("SELECT prompt_hash, filtered_at FROM prompt_filter_events ORDER BY filtered_at").fetchall()
+        finally:
+            db.close()
+        for key, filtered_at in rows:
+            events = self._events.pop(key, None) or collections.deque(maxlen=max(1, self.threshold))
+            events.append(filtered_at)
+            self._events[key] = events
+        while len(self._events) > self.max_entries:
+            self._events.popitem(last=False)
+        metrics.set_gauge("prefilter.entries", len(self._events))
+
+filter_history = FilterHistory(FILTER_BLOCK_THRESHOLD, FILTER_WINDOW_HOURS * 3600, FILTER_HISTORY_MAX_ENTRIES)
+
+# Streaming decode of the JSON artifacts response
+STREAM_CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_SIZE", str(64 * 1024)))
+# Ask for raw PNG bytes (Accept: image/png) when only one sample is requested
+BINARY_SINGLE_SAMPLE = env_flag("BINARY_SINGLE_SAMPLE", True)
+ARTIFACT_B64_KEYS = (b"base64", b"b64_json", b"b64")
+_STRING_STOP = re.compile(rb'["\\]')
+
+class ArtifactStreamParser:
+    """
+    Incremental parser for the text-to-image JSON response.
+    Any object holding a base64 field is treated as an artifact: its base64 text is
+    decoded chunk by chunk straight into one bytearray, and the artifact is returned
+    from feed() as soon as its object closes. Other values are small and kept as-is.
+    """
+    def __init__(self):
+        self._buf = b""
+        self._stack = []        # frames: {"obj": bool, "key": bytes|None, "expect_key": bool, "fields": dict, "out": bytearray|None}
+        self._str_raw = None    # raw bytes of the string currently being read (non-base64)
+        self._b64_frame = None  # frame whose base64 value is being streamed
+        self._b64_pending = b""
+        self._scalar = None     # raw bytes of the number/literal currently being read
+        self._done = False
+
+    def feed(self, chunk: bytes) -> list[dict]:
+        samples = []
+        data = self._buf + chunk if self._buf else chunk
+        self._buf = b""
+        pos = 0
+        end = len(data)
+        while pos < end:
+            if self._b64_frame is not None:
+                pos = self._feed_b64(data, pos)
+                continue
+            if self._str_raw is not None:
+                pos = self._feed_string(data, pos)
+                continue
+            c = data[pos:pos + 1]
+            if self._scalar is not None:
+                if c in b",}] \t\r\n":
+                    self._set_value(json.loads(self._scalar))
+                    self._scalar = None
+                else:
+                    self._scalar += c
+                    pos += 1
+                    continue
+            if c in b" \t\r\n:,":
+                if c == b",":
+                    frame = self._stack[-1] if self._stack else None
+                    if frame is not None and frame["obj"]:
+                        frame["expect_key"] = True
+                pos += 1
+            elif c == b"{" or c == b"[":
+                self._stack.append({"obj": c == b"{", "key": None, "expect_key": c == b"{", "fields": {}, "out": None})
+                pos += 1
+            elif c == b"}" or c == b"]":
+                frame = self._stack.pop()
+                if frame["out"] is not None:
+                    fields = frame["fields"]
+                    samples.append({
+                        "bytes": frame["out"],
+                        "seed": fields.get("seed"),
+                        "finish_reason": fields.get("finishReason") or fields.get("finish_reason"),
+                    })
+                if not self._stack:
+                    self._done = True
+                pos += 1
+            elif c == b'"':
+                frame = self._stack[-1] if self._stack else None
+                pos += 1
+                if frame is not None and frame["obj"] and not frame["expect_key"] and frame["key"] in ARTIFACT_B64_KEYS:
+                    frame["out"] = bytearray()
+                    self._b64_frame = frame
+                    self._b64_pending = b""
+                else:
+                    self._str_raw = b""
+            else:
+                self._scalar = c
+                pos += 1
+        return samples
+
+    def _feed_string(self, data: bytes, pos: int) -> int:
+        m = _STRING_STOP.search(data, pos)
+        if m is None:
+            self._str_raw += data[pos:]
+            return len(data)
+        i = m.start()
+        if data[i:i + 1] == b"\\":
+            if i + 1 >= len(data):
+                # escape split across chunks: keep it for the next feed()
+                self._str_raw += data[pos:i]
+                self._buf = data[i:]
+                return len(data)
+            self._str_raw += data[pos:i + 2]
+            return i + 2
+        self._str_raw += data[pos:i]
+        value = json.loads(b'"' + self._str_raw + b'"')
+        self._str_raw = None
+        frame = self._stack[-1] if self._stack else None
+        if frame is not None and frame["obj"] and frame["expect_key"]:
+            frame["key"] = value.encode()
+            frame["expect_key"] = False
+        else:
+            self._set_value(value)
+        return i + 1
+
+    def _feed_b64(self, data: bytes, pos: int) -> int:
+        m = _STRING_STOP.search(data, pos)
+        stop = len(data) if m is None else m.start()
+        self._decode_b64(data[pos:stop])
+        if m is None:
+            return stop
+        if data[stop:stop + 1] == b"\\":
+            if stop + 1 >= len(data):
+                self._buf = data[stop:]
+                return len(data)
+            # only "\/" can carry base64 data; other escapes are line breaks etc.
+            if data[stop + 1:stop + 2] == b"/":
+                self._decode_b64(b"/")
+            return stop + 2
+        if self._b64_pending:
+            self._decode_b64(b"", final=True)
+        frame = self._b64_frame
+        self._b64_frame = None
+        frame["expect_key"] = False
+        return stop + 1
+
+    def _decode_b64(self, part: bytes, final: bool = False):
+        data = self._b64_pending + part if self._b64_pending else part
+        n = len(data) if final else len(data) - len(data) % 4
+        try:
+            self._b64_frame["out"] += binascii.a2b_base64(data[:n])
+        except binascii.Error as e:
+            raise Exception("Failed to decode base64 image: " + str(e))
+        self._b64_pending = data[n:]
+
+    def _set_value(self, value):
+        frame = self._stack[-1] if self._stack else None
+        if frame is not None and frame["obj"] and frame["key"] is not None:
+            frame["fields"][frame["key"].decode()] = value
+
+    def close(self):
+        if not self._done or self._buf or self._stack:
+            raise Exception("Stability API response ended unexpectedly")
+
+async def read_binary_artifact(resp: aiohttp.ClientResponse) -> dict:
+    """Reads an image/png response into one buffer; seed/finish reason come from headers."""
+    out = bytearray()
+    async for chunk in resp.content.iter_chunked(STREAM_CHUNK_SIZE):
+        out += chunk
+    seed_header = resp.headers.get("Seed")
+    seed_val = int(seed_header) if seed_header and seed_header.isdigit() else None
+    return {"bytes": out, "seed": seed_val, "finish_reason": resp.headers.get("Finish-Reason")}
+
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+
+class StabilityAPIError(Exception):
+    def __init__(self, status: int, body: str, retry_after: float | None = None):
+        super().__init__(f"Stability API error {status}: {body}")
+        self.status = status
+        self.body = body
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self) -> bool:
+        return self.status in RETRYABLE_STATUSES
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Retry-After is either delay-seconds or an HTTP date."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+def retry_delay(error: Exception, attempt: int, deadline: float | None) -> float | None:
+    """
+    Returns how long to sleep before the next attempt, or None when the error must not
+    be retried (not retryable, attempts used up, or not enough time left before deadline).
+    Only requests that never produced a result are retried: 429/5xx responses and
+    connection failures. Timeouts are not retried since the generation may still be billed.
+    """
+    if isinstance(error, StabilityAPIError):
+        if not error.retryable:
+            return None
+    elif not isinstance(error, aiohttp.ClientConnectionError):
+        return None
+    if attempt >= RETRY_MAX_ATTEMPTS:
+        return None
+    # full jitter, bounded
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** (attempt - 1))))
+    retry_after = getattr(error, "retry_after", None)
+    if retry_after is not None:
+        if retry_after > RETRY_MAX_DELAY:
+            return None
+        delay = retry_after + random.uniform(0, RETRY_BASE_DELAY)
+    if deadline is not None and time.monotonic() + delay > deadline - DEADLINE_MARGIN:
+        return None
+    return delay
+
+async def post_generation(url: str, headers: dict, payload: dict, deadline: float | None = None,
+                          **request_kwargs) -> aiohttp.ClientResponse:
+    """
+    POSTs a generation request, retrying safe-to-retry failures.
+    Returns the (status 200) response; the caller must release it.
+    """
+    session = get_http_session()
+    # latency per megapixel-step, so small and large requests are comparable for the limiter
+    work = max(1e-6, payload["width"] * payload["height"] * payload["steps"] * payload["samples"] / 1e6)
+    attempt = 0
+    waited = 0.0
+    while True:
+        attempt += 1
+        started = time.monotonic()
+        try:
+            resp = await session.post(url, headers=headers, json=payload, **request_kwargs)
+        except aiohttp.ClientConnectionError as e:
+            error = e
+            generation_limiter.record("error")
+        else:
+            if resp.status == 200:
+                generation_limiter.record("ok", (time.monotonic() - started) / work)
+                if waited:
+                    metrics.observe("stability.retry_wait_per_job", waited)
+                return resp
+            async with resp:
+                text = await resp.text()
+            error = StabilityAPIError(resp.status, text, parse_retry_after(resp.headers.get("Retry-After")))
+            if resp.status == 429:
+                generation_limiter.record("throttled")
+            elif resp.status >= 500:
+                generation_limiter.record("error")
+
+        delay = retry_delay(error, attempt, deadline)
+        if delay is None:
+            if attempt > 1:
+                metrics.inc("stability.retries_exhausted")
+            raise error
+        reason = str(error.status) if isinstance(error, StabilityAPIError) else "connection"
+        metrics.inc("stability.retries")
+        metrics.inc(f"stability.retries.{reason}")
+        metrics.observe("stability.retry_delay", delay)
+        print(f"Stability API attempt {attempt} failed ({reason}), retrying in {delay:.1f}s")
+        waited += delay
+        await asyncio.sleep(delay)
+
+class NegativeCache:
+    """
+    Short-TTL memory of upstream rejections that depend only on the generation
+    parameters, e.g. a size the model does not support. Keyed by
+    (model, width, height, steps, samples, cfg_scale); the entry keeps the status
+    and error name so a matching request fails immediately with the same error.
+    Only 400/404 with an error name from PARAMETER_ERRORS are remembered; generic
+    ones such as bad_request can be caused by the prompt, which is not in the key.
+    """
+    STATUSES = (400, 404)
+    PARAMETER_ERRORS = {
+        "invalid_height", "invalid_width", "invalid_dimensions", "invalid_samples",
+        "invalid_steps", "invalid_cfg_scale", "engine_not_found", "not_found",
+    }
+    # a parameter error whose message points at the prompt or seed is still not cached
+    UNKEYED_FIELDS = ("prompt", "seed", "text")
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max(1, max_entries)
+        self._entries = collections.OrderedDict()  # key -> (expires (monotonic), status, error name, body)
+
+    @staticmethod
+    def key(model: str, width: int, height: int, steps: int, samples: int, cfg_scale: float) -> tuple:
+        return (model, int(width), int(height), int(steps), int(samples), float(cfg_scale))
+
+    @staticmethod
+    def parse_error(body: str) -> tuple[str, str]:
+        """(name, message) from a Stability error body; empty strings when it is not one."""
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return "", ""
+        if not isinstance(data, dict):
+            return "", ""
+        return str(data.get("name") or ""), str(data.get("message") or "")
+
+    def get(self, key: tuple) -> StabilityAPIError | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires, status, name, body = entry
+        if expires <= time.monotonic():
+            del self._entries[key]
+            return None
+        metrics.inc("negative_cache.hits")
+        metrics.inc(f"negative_cache.hits.{name or status}")
+        return StabilityAPIError(status, body)
+
+    def remember(self, key: tuple, error: StabilityAPIError):
+        if self.ttl <= 0 or error.status not in self.STATUSES:
+            return
+        name, message = self.parse_error(error.body)
+        if name.lower() not in self.PARAMETER_ERRORS:
+            return
+        if any(field in message.lower() for field in self.UNKEYED_FIELDS):
+            return
+        self._entries.pop(key, None)
+        self._entries[key] = (time.monotonic() + self.ttl, error.status, name, error.body)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        metrics.inc("negative_cache.stored")
+
+    def clear(self):
+        self._entries.clear()
+
+negative_cache = NegativeCache(NEGATIVE_CACHE_TTL, NEGATIVE_CACHE_MAX_ENTRIES)
+
+# engine id -> engine description, from the last catalog refresh
+model_catalog = {}
+
+async def refresh_model_catalog():
+    """Fetches the engines list; a new catalog may accept what was rejected, so the negative cache is dropped."""
+    global model_catalog
+    session = get_http_session()
+    headers = {"Authorization": f"Bearer {STABILITY_API_KEY}", "Accept": "application/json"}
+    async with session.get(f"{STABILITY_API_HOST}/v1/engines/list", headers=headers) as resp:
+        if resp.status != 200:
+            raise StabilityAPIError(resp.status, await resp.text())
+        engines = await resp.json()
+    model_catalog = {e["id"]: e for e in engines if isinstance(e, dict) and "id" in e}
+    negative_cache.clear()
+    metrics.set_gauge("model_catalog.engines", len(model_catalog))
+
+async def model_catalog_loop():
+    while True:
+        try:
+            await refresh_model_catalog()
+        except (aiohttp.ClientError, asyncio.TimeoutError, StabilityAPIError, ValueError) as e:
+            print(f"Model catalog refresh failed: {e}")
+        await asyncio.sleep(MODEL_CATALOG_REFRESH_INTERVAL)
+
+async def iter_stability_generate(prompt: str,
                                   negative_prompt: str | None = None,
                                   steps: int = 30,
                                   cfg_scale: float = 7.0,
@@ -97,17 +1536,23 @@ async def call_stability_generate(prompt: str,
                                   samples: int = 1,
                                   seed: int | None = None,
                                   model: str = DEFAULT_MODEL,
-                                  timeout: int = 180):
+                                  timeout: aiohttp.ClientTimeout | None = None,
+                                  deadline: float | None = None):
     """
-    Calls Stability API text-to-image generation endpoint and returns list of dicts:
-    [{'bytes': b'...', 'seed': 123, 'finish_reason': 'SUCCESS'}, ...]
-    Raises Exception on HTTP error.
+    Async generator version of call_stability_generate: reads the response body in
+    chunks and yields each {'bytes', 'seed', 'finish_reason'} dict as soon as its
+    artifact is fully decoded, so the whole JSON body is never held in memory.
+    Single-sample requests use the binary (image/png) response, with seed and
+    finish reason taken from the response headers.
+    Retryable failures are retried while `deadline` (time.monotonic()) allows it.
+    Raises StabilityAPIError on HTTP error.
     """
-    url = f"https://api.stability.ai/v1/generation/{model}/text-to-image"
+    binary = BINARY_SINGLE_SAMPLE and int(samples) == 1
+    url = f"{STABILITY_API_HOST}/v1/generation/{model}/text-to-image"
     headers = {
         "Authorization": f"Bearer {STABILITY_API_KEY}",
         "Content-Type": "application/json",
-        "Accept": "application/json",
+        "Accept": "image/png" if binary else "application/json",
     }
 
     text_prompts = [{"text": prompt, "weight": 1.0}]
@@ -125,46 +1570,244 @@ async def call_stability_generate(prompt: str,
     if seed:
         payload["seed"] = int(seed)
 
-    await generation_semaphore.acquire()
+    request_kwargs = {}
+    if timeout is not None:
+        request_kwargs["timeout"] = timeout
+
+    rejection_key = NegativeCache.key(model, width, height, steps, samples, cfg_scale)
+    cached_error = negative_cache.get(rejection_key)
+    if cached_error is not None:
+        raise cached_error
+
+    slot = reserved_slot.get()
+    if slot is None or not slot.claim():
+        await generation_limiter.acquire()
+    started = time.monotonic()
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, headers=headers, json=payload, timeout=timeout) as resp:
-                text = await resp.text()
-                if resp.status != 200:
-                    raise Exception(f"Stability API error {resp.status}: {text}")
-                data = json.loads(text)
+        try:
+            resp = await post_generation(url, headers, payload, deadline, **request_kwargs)
+        except StabilityAPIError as e:
+            negative_cache.remember(rejection_key, e)
+            raise
+        async with resp:
+            if binary:
+                sample = await read_binary_artifact(resp)
+                generation_latency.record(model, width, height, steps, samples, time.monotonic() - started)
+                yield sample
+                return
+            parser = ArtifactStreamParser()
+            async for chunk in resp.content.iter_chunked(STREAM_CHUNK_SIZE):
+                # scanning + base64 decoding runs on the decode threads, one chunk at a time
+                for sample in await cpu_pool.run_thread(parser.feed, chunk):
+                    yield sample
+            parser.close()
+        generation_latency.record(model, width, height, steps, samples, time.monotonic() - started)
     finally:
-        generation_semaphore.release()
-
-    artifacts = data.get("artifacts") or data.get("result") or []
-    # Normalize nested arrays
-    if artifacts and isinstance(artifacts[0], list):
-        artifacts = artifacts[0]
+        generation_limiter.release()
 
+async def call_stability_generate(prompt: str,
+                                  negative_prompt: str | None = None,
+                                  steps: int = 30,
+                                  cfg_scale: float = 7.0,
+                                  width: int = 512,
+                                  height: int = 512,
+                                  samples: int = 1,
+                                  seed: int | None = None,
+                                  model: str = DEFAULT_MODEL,
+                                  timeout: aiohttp.ClientTimeout | None = None,
+                                  deadline: float | None = None):
+    """
+    Calls Stability API text-to-image generation endpoint and returns list of dicts:
+    [{'bytes': b'...', 'seed': 123, 'finish_reason': 'SUCCESS'}, ...]
+    Raises StabilityAPIError on HTTP error.
+    Uses the shared session; `timeout` overrides the session defaults.
+    """
     results = []
-    for art in artifacts:
-        b64 = art.get("base64") or art.get("b64_json") or art.get("b64")
-        finish = art.get("finishReason") or art.get("finish_reason") or art.get("finishReason")
-        seed_val = art.get("seed")
-        if not b64:
-            continue
-        try:
-            img_bytes = base64.b64decode(b64)
-        except Exception as e:
-            raise Exception("Failed to decode base64 image: " + str(e))
-        results.append({"bytes": img_bytes, "seed": seed_val, "finish_reason": finish})
+    async with aclosing(iter_stability_generate(prompt=prompt,
+                                                negative_prompt=negative_prompt,
+                                                steps=steps,
+                                                cfg_scale=cfg_scale,
+                                                width=width,
+                                                height=height,
+                                                samples=samples,
+                                                seed=seed,
+                                                model=model,
+                                                timeout=timeout,
+                                                deadline=deadline)) as stream:
+        async for sample in stream:
+            results.append(sample)
     return results
 
-def log_usage(user: discord.User, prompt: str, negative_prompt: str | None, model: str,
+def generation_key(model: str, prompt: str, negative_prompt: str | None, seed: int | None,
+                   width: int, height: int, steps: int, cfg_scale: float, samples: int) -> tuple:
+    """Normalized parameter tuple identifying one (deterministic, when seeded) generation."""
+    return (model,
+            " ".join(prompt.split()),
+            " ".join((negative_prompt or "").split()),
+            int(seed) if seed else None,
+            int(width), int(height), int(steps), round(float(cfg_scale), 2), int(samples))
+
+class SingleFlight:
+    """
+    Runs at most one call per key; concurrent callers with the same key share its result.
+    The call is cancelled only once every caller waiting on it has been cancelled.
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self._calls = {}    # key -> asyncio.Task
+        self._waiters = {}  # key -> number of callers awaiting the task
+
+    async def do(self, key, factory):
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(factory())
+            self._calls[key] = task
+            self._waiters[key] = 0
+            task.add_done_callback(lambda t: self._done(key, t))
+            metrics.inc(f"{self.name}.calls")
+        else:
+            metrics.inc(f"{self.name}.coalesced")
+        metrics.set_gauge(f"{self.name}.in_flight", len(self._calls))
+        self._waiters[key] += 1
+        try:
+            # shield: one caller giving up must not cancel the call for the others
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if self._calls.get(key) is task and self._waiters[key] == 1 and not task.done():
+                task.cancel()
+            raise
+        finally:
+            if self._calls.get(key) is task:
+                self._waiters[key] -= 1
+
+    def _done(self, key, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+            del self._waiters[key]
+        metrics.set_gauge(f"{self.name}.in_flight", len(self._calls))
+        if not task.cancelled():
+            task.exception()  # mark retrieved even if every caller went away
+
+generation_flights = SingleFlight("generation_flights")
+
+class ResultCache(DiskLRU):
+    """
+    Content-addressed disk cache for seeded generations (deterministic for a given
+    parameter tuple). One file per entry: 4-byte header length, JSON header with
+    seed/finish_reason/size per sample, then the raw image bytes. Files are written
+    to a temp name and renamed, and evicted least-recently-used by total byte size.
+    """
+    SUFFIX = ".bin"
+    METRIC = "result_cache"
+
+    @staticmethod
+    def key_for(params: tuple) -> str:
+        return hashlib.sha256(json.dumps(list(params), ensure_ascii=False).encode()).hexdigest()
+
+    async def get(self, key: str) -> list[dict] | None:
+        if not self.enabled or key not in self._index:
+            metrics.inc("result_cache.misses")
+            return None
+        try:
+            results = await asyncio.to_thread(self._read, key)
+        except (OSError, ValueError):
+            self._forget(key)
+            metrics.inc("result_cache.misses")
+            return None
+        if key in self._index:
+            self._index.move_to_end(key)
+        metrics.inc("result_cache.hits")
+        return results
+
+    async def put(self, key: str, results: list[dict]):
+        if not self.enabled or not results:
+            return
+        size = await asyncio.to_thread(self._write, key, results)
+        await self._admit(key, size)
+
+    def _read(self, key: str) -> list[dict]:
+        path = self._path(key)
+        with open(path, "rb") as f:
+            header_len = int.from_bytes(f.read(4), "big")
+            header = json.loads(f.read(header_len))
+            results = []
+            for meta in header["samples"]:
+                data = f.read(meta["size"])
+                if len(data) != meta["size"]:
+                    raise ValueError("truncated cache entry")
+                results.append({"bytes": data, "seed": meta["seed"], "finish_reason": meta["finish_reason"]})
+        os.utime(path)  # keeps LRU order across restarts
+        return results
+
+    def _write(self, key: str, results: list[dict]) -> int:
+        header = json.dumps({"samples": [
+            {"seed": r.get("seed"), "finish_reason": r.get("finish_reason"), "size": len(r["bytes"])}
+            for r in results
+        ]}).encode()
+        tmp = self._tmp_path(key)
+        with open(tmp, "wb") as f:
+            f.write(len(header).to_bytes(4, "big"))
+            f.write(header)
+            for r in results:
+                f.write(r["bytes"])
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self._path(key))
+        return os.path.getsize(self._path(key))
+
+result_cache = ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_MAX_BYTES)
+
+async def generate_images(prompt: str,
+                          negative_prompt: str | None = None,
+                          steps: int = 30,
+                          cfg_scale: float = 7.0,
+                          width: int = 512,
+                          height: int = 512,
+                          samples: int = 1,
+                          seed: int | None = None,
+                          model: str = DEFAULT_MODEL,
+                          deadline: float | None = None):
+    """
+    Entry point used by /resim. Seeded requests are deterministic, so they are
+    answered from the disk cache when possible, and identical concurrent ones are
+    coalesced into a single upstream call; every caller gets its own copy of the results.
+    """
+    async def factory():
+        results = await call_stability_generate(prompt=prompt,
+                                                negative_prompt=negative_prompt,
+                                                steps=steps,
+                                                cfg_scale=cfg_scale,
+                                                width=width,
+                                                height=height,
+                                                samples=samples,
+                                                seed=seed,
+                                                model=model,
+                                                deadline=deadline)
+        if seed:
+            try:
+                await result_cache.put(cache_key, results)
+            except OSError as e:
+                print(f"Result cache write failed: {e}")
+        return results
+    if not seed:
+        return await factory()
+    key = generation_key(model, prompt, negative_prompt, seed, width, height, steps, cfg_scale, samples)
+    cache_key = ResultCache.key_for(key)
+    cached = await result_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    results = await generation_flights.do(key, factory)
+    return [dict(r, bytes=bytes(r["bytes"])) for r in results]
+
+def log_usage(user_id: int, username: str, prompt: str, negative_prompt: str | None, model: str,
               seed: int | None, width:int, height:int, steps:int, samples:int, cfg_scale:float):
     ts = datetime.now(timezone.utc).isoformat()
-    cursor.execute("""
+    db_writer.execute("""
     INSERT INTO usages (user_id, username, prompt, negative_prompt, model, seed, width, height, steps, samples, cfg_scale, timestamp)
     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (str(user.id), f"{user.name}#{user.discriminator}", prompt, negative_prompt, model, seed, width, height, steps, samples, cfg_scale, ts))
-    conn.commit()
+    """, (str(user_id), username, prompt, negative_prompt, model, seed, width, height, steps, samples, cfg_scale, ts))
 
-def make_result_embed(prompt: str, negative_prompt: str | None, model: str, seed: int | None, width:int, height:int, steps:int, samples:int, cfg_scale:float):
+def make_result_embed(prompt: str, negative_prompt: str | None, model: str, seed: int | str | None, width:int, height:int, steps:int, samples:int, cfg_scale:float):
     embed = discord.Embed(title="🖼️ Resim oluşturuldu", description=f"**Prompt:** {prompt[:3500]}", color=0x2ecc71)
     if negative_prompt:
         embed.add_field(name="Negative prompt", value=(negative_prompt[:1024]), inline=False)
@@ -173,6 +1816,743 @@ def make_result_embed(prompt: str, negative_prompt: str | None, model: str, seed
     embed.set_footer(text="Stability AI ile üretildi")
     return embed
 
+@dataclass
+class Job:
+    """One /resim request. `params` holds the clamped generate_images() arguments."""
+    id: str
+    user_id: int
+    username: str
+    guild_id: int | None
+    application_id: int
+    token: str
+    token_expires_at: float  # unix time the interaction token expires
+    params: dict
+    cost: float = 1.0
+    upload_limit: int = DEFAULT_UPLOAD_LIMIT  # bytes per message in the target guild
+    state: str = "queued"
+    enqueued_at: float = field(default_factory=time.monotonic)
+    started_at: float | None = None
+    progress_text: str | None = None  # last text written to the deferred response
+    progress_edited_at: float = 0.0
+
+    def estimated_duration(self) -> float:
+        p = self.params
+        # fanned-out samples run side by side, so the job takes about as long as one of them
+        samples = 1 if SPLIT_SAMPLES else p["samples"]
+        return generation_latency.estimate(p["model"], p["width"], p["height"], p["steps"], samples)
+
+    @property
+    def deadline(self) -> float:
+        """time.monotonic() value at which the interaction token expires."""
+        return time.monotonic() + self.token_expires_at - time.time()
+
+    def followup(self) -> discord.Webhook:
+        # same webhook as Interaction.followup, rebuilt from the stored token so resumed jobs can reply too
+        payload = {"id": self.application_id, "type": 3, "token": self.token}
+        return discord.Webhook.from_state(data=payload, state=bot._connection)
+
+class FairScheduler:
+    """
+    Weighted fair queuing across guilds, round-robin across users inside a guild.
+    Every backlogged guild has a virtual time; the guild with the smallest one is
+    served next and its virtual time advances by job cost / weight, so under saturation
+    each guild gets credits' worth of work in proportion to its weight. Same put_nowait()/get()
+    shape as asyncio.Queue.
+    """
+    def __init__(self, weights: dict[int, float]):
+        self.weights = weights
+        self._guilds = {}   # guild key -> {"vtime": float, "users": OrderedDict[user_id, deque[Job]]}
+        self._vclock = 0.0
+        self._size = 0
+        self._getters = collections.deque()
+
+    @staticmethod
+    def _guild_key(job) -> str:
+        return str(job.guild_id) if job.guild_id else "dm"
+
+    def qsize(self) -> int:
+        return self._size
+
+    def put_nowait(self, job):
+        key = self._guild_key(job)
+        guild = self._guilds.get(key)
+        if guild is None:
+            # a guild that was idle starts at the current virtual clock, not with saved-up credit
+            guild = self._guilds[key] = {"vtime": self._vclock, "users": collections.OrderedDict()}
+        users = guild["users"]
+        if job.user_id not in users:
+            users[job.user_id] = collections.deque()
+        users[job.user_id].append(job)
+        self._size += 1
+        self._wake_getter()
+
+    async def wait_nonempty(self):
+        while not self._size:
+            fut = asyncio.get_running_loop().create_future()
+            self._getters.append(fut)
+            try:
+                await fut
+            except asyncio.CancelledError:
+                if fut.done() and not fut.cancelled():
+                    self._wake_getter()
+                raise
+
+    async def get(self):
+        await self.wait_nonempty()
+        return self._pop()
+
+    def get_nowait(self):
+        if not self._size:
+            raise asyncio.QueueEmpty()
+        return self._pop()
+
+    def _pop(self):
+        key, guild = min(self._guilds.items(), key=lambda item: (item[1]["vtime"], item[0]))
+        users = guild["users"]
+        user_id, jobs = next(iter(users.items()))
+        job = jobs.popleft()
+        del users[user_id]
+        if jobs:
+            users[user_id] = jobs  # back of the round-robin
+        self._vclock = guild["vtime"]
+        weight = self.weights.get(job.guild_id, 1.0) if job.guild_id else 1.0
+        guild["vtime"] += job.cost / max(weight, 1e-3)
+        if not users:
+            del self._guilds[key]
+        self._size -= 1
+        waited = time.monotonic() - job.enqueued_at
+        metrics.observe("queue_wait", waited)
+        # per-guild series only for the configured guilds, so the metric set stays bounded
+        metrics.observe(f"queue_wait.guild.{key if job.guild_id in self.weights else 'other'}", waited)
+        return job
+
+    def ordered(self) -> list:
+        """Queued jobs in the order they would be dispatched if nothing else arrived."""
+        heap = []
+        for key, guild in self._guilds.items():
+            users = collections.deque(collections.deque(jobs) for jobs in guild["users"].values())
+            heap.append((guild["vtime"], key, users))
+        heapq.heapify(heap)
+        order = []
+        while heap:
+            vtime, key, users = heapq.heappop(heap)
+            jobs = users.popleft()
+            job = jobs.popleft()
+            if jobs:
+                users.append(jobs)
+            order.append(job)
+            if users:
+                weight = self.weights.get(job.guild_id, 1.0) if job.guild_id else 1.0
+                heapq.heappush(heap, (vtime + job.cost / max(weight, 1e-3), key, users))
+        return order
+
+    def _wake_getter(self):
+        while self._getters:
+            fut = self._getters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                break
+
+class JobQueue:
+    """
+    Explicit job queue backed by the `jobs` table. State changes
+    (queued -> running -> uploading -> done/failed) go through the DB writer
+    thread; workers pull jobs from the in-memory fair scheduler.
+    """
+    ACTIVE_STATES = ("queued", "running", "uploading")
+
+    def __init__(self, path: str, writer: SQLiteWriter):
+        self.path = path
+        self.writer = writer
+        self._queue = FairScheduler(GUILD_WEIGHTS)
+        self.closed = False  # set on shutdown: workers stop taking jobs
+        self.running = {}  # job id -> Job, while generating
+
+    def submit(self, job: Job):
+        now = time.time()
+        self.writer.execute("""
+        INSERT INTO jobs (id, state, user_id, username, guild_id, application_id, interaction_token, token_expires_at, params, created_at, updated_at, upload_limit)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (job.id, job.state, str(job.user_id), job.username, str(job.guild_id) if job.guild_id else None,
+              str(job.application_id), job.token, job.token_expires_at, json.dumps(job.params), now, now, job.upload_limit))
+        self._enqueue(job)
+
+    def _enqueue(self, job: Job):
+        job.state = "queued"
+        job.enqueued_at = time.monotonic()
+        self._queue.put_nowait(job)
+        metrics.set_gauge("jobs.queued", self._queue.qsize())
+
+    async def wait_nonempty(self):
+        await self._queue.wait_nonempty()
+
+    def get_nowait(self) -> Job:
+        job = self._queue.get_nowait()
+        metrics.set_gauge("jobs.queued", self._queue.qsize())
+        return job
+
+    def set_state(self, job: Job, state: str, error: str | None = None):
+        job.state = state
+        if state == "running":
+            job.started_at = time.monotonic()
+            self.running[job.id] = job
+        else:
+            self.running.pop(job.id, None)
+        metrics.inc(f"jobs.{state}")
+        self.writer.execute("UPDATE jobs SET state = ?, error = ?, updated_at = ? WHERE id = ?",
+                            (state, error, time.time(), job.id))
+
+    def estimates(self) -> list[tuple[Job, int, float]]:
+        """
+        (job, position, eta seconds) for each queued job. The ETA spreads the remaining
+        work of running jobs and of the jobs ahead over the current concurrency window.
+        """
+        slots = max(1, generation_limiter.limit)
+        now = time.monotonic()
+        ahead = sum(max(0.0, job.estimated_duration() - (now - job.started_at))
+                    for job in self.running.values() if job.started_at is not None)
+        result = []
+        for position, job in enumerate(self._queue.ordered(), start=1):
+            duration = job.estimated_duration()
+            result.append((job, position, ahead / slots + duration))
+            ahead += duration
+        return result
+
+    def backlog_seconds(self) -> float:
+        """Estimated seconds until a job submitted now would start (upper bound under fair queuing)."""
+        now = time.monotonic()
+        work = sum(max(0.0, job.estimated_duration() - (now - job.started_at))
+                   for job in self.running.values() if job.started_at is not None)
+        work += sum(job.estimated_duration() for job in self._queue.ordered())
+        return work / max(1, generation_limiter.limit)
+
+    def load_pending(self, margin: float) -> tuple[list[Job], list[tuple[Job, str]]]:
+        """
+        Blocking, called once at startup: returns (resumable jobs, [(job, reason)] to
+        drop) for jobs left active by the previous process. Only jobs that were still
+        queued are resumed, while their interaction token stays valid for at least
+        `margin` more seconds; running/uploading ones may already have been paid
+        for or posted, so they are not run a second time.
+        """
+        db = sqlite3.connect(self.path)
+        try:
+            rows = db.execute(f"""
+            SELECT id, state, user_id, username, guild_id, application_id, interaction_token, token_expires_at, params, upload_limit
+            FROM jobs WHERE state IN ({",".join("?" * len(self.ACTIVE_STATES))}) ORDER BY created_at
+            """, self.ACTIVE_STATES).fetchall()
+        finally:
+            db.close()
+        resumable, dropped = [], []
+        now = time.time()
+        for job_id, state, user_id, username, guild_id, app_id, token, expires_at, params, upload_limit in rows:
+            p = json.loads(params)
+            job = Job(id=job_id, user_id=int(user_id), username=username,
+                      guild_id=int(guild_id) if guild_id else None, application_id=int(app_id),
+                      token=token, token_expires_at=expires_at, params=p,
+                      cost=estimate_cost(p["model"], p["width"], p["height"], p["steps"], p["samples"]),
+                      upload_limit=upload_limit or DEFAULT_UPLOAD_LIMIT)
+            if state != "queued":
+                dropped.append((job, "interrupted by restart"))
+            elif expires_at - now < margin:
+                dropped.append((job, "expired during restart"))
+            else:
+                resumable.append(job)
+        return resumable, dropped
+
+    def resume(self, jobs: list[Job], dropped: list[tuple[Job, str]]):
+        for job, reason in dropped:
+            job.state = "failed"
+            self.writer.execute("UPDATE jobs SET state = 'failed', error = ?, updated_at = ? WHERE id = ?",
+                                (reason, time.time(), job.id))
+        for job in jobs:
+            self.set_state(job, "queued")
+            self._enqueue(job)
+        cutoff = time.time() - JOB_RETENTION_HOURS * 3600
+        self.writer.execute("DELETE FROM jobs WHERE state IN ('done', 'failed') AND updated_at < ?", (cutoff,))
+        if jobs or dropped:
+            print(f"Job queue: resumed {len(jobs)} job(s), dropped {len(dropped)} expired or interrupted job(s)")
+
+job_queue = JobQueue(DB_PATH, db_writer)
+
+async def notify_dropped_jobs(dropped: list[tuple[Job, str]]):
+    """Tells the users of jobs dropped at startup, while their interaction token still works."""
+    for job, reason in dropped:
+        if job.token_expires_at - time.time() < 5:
+            continue
+        if reason == "interrupted by restart":
+            text = "Bot yeniden başlatıldığı için işin yarıda kaldı ve iptal edildi. Lütfen tekrar dene."
+        else:
+            text = "Bot yeniden başlatılırken isteğinin süresi doldu ve iptal edildi. Lütfen tekrar dene."
+        try:
+            await job.followup().send(text, ephemeral=True)
+        except discord.HTTPException as e:
+            print(f"Could not notify the user of dropped job {job.id}: {e}")
+
+def format_eta(seconds: float) -> str:
+    seconds = int(seconds + 0.5)
+    if seconds < 60:
+        return f"{seconds} sn"
+    return f"{seconds // 60} dk {seconds % 60} sn"
+
+async def edit_progress(job: Job, text: str, force: bool = False) -> bool:
+    """Edits the deferred response, at most once per PROGRESS_UPDATE_INTERVAL per job."""
+    now = time.monotonic()
+    if text == job.progress_text or (not force and now - job.progress_edited_at < PROGRESS_UPDATE_INTERVAL):
+        return False
+    job.progress_text = text
+    job.progress_edited_at = now
+    try:
+        await job.followup().edit_message("@original", content=text)
+    except discord.HTTPException as e:
+        print(f"Progress update for job {job.id} failed: {e}")
+        return False
+    metrics.inc("progress.edits")
+    return True
+
+async def progress_update_loop():
+    """
+    Periodically writes queue position and ETA into the deferred responses of jobs
+    that have been waiting for a while; jobs that start right away keep the plain
+    "thinking..." state, so their first followup still replaces it.
+    """
+    while True:
+        await asyncio.sleep(PROGRESS_UPDATE_INTERVAL)
+        edits = 0
+        now = time.monotonic()
+        for job, position, eta in job_queue.estimates():
+            if edits >= PROGRESS_MAX_EDITS_PER_TICK:
+                break
+            if now - job.enqueued_at < PROGRESS_UPDATE_INTERVAL:
+                continue
+            text = f"⏳ Sıradasın: **{position}.** • Tahmini süre: ~{format_eta(eta)}"
+            if await edit_progress(job, text):
+                edits += 1
+
+class NoImagesError(Exception):
+    """Stability answered, but without any image."""
+
+class GenerationTimeoutError(Exception):
+    """No sample was generated before the job's generation deadline."""
+
+def split_seeds(seed: int | None, samples: int) -> list[int]:
+    """
+    Seeds for fanned-out single-sample calls: seed, seed+1, ... (random base when no
+    seed is given), wrapping within 1..2**32-1 since 0 means "random" upstream.
+    """
+    base = int(seed) if seed else random.randrange(1, 2 ** 32 - samples)
+    return [1 + (base - 1 + i) % (2 ** 32 - 1) for i in range(samples)]
+
+async def iter_split_generate(params: dict, deadline: float):
+    """
+    Fans a multi-sample request out into concurrent single-sample calls (each under
+    the same concurrency limiter) and yields (index, results, error) as each one
+    finishes, so a failed sample doesn't hold back the others. Only a user-given
+    seed goes through generate_images() (cache and coalescing); random base seeds
+    are never asked for again, so they call the API directly.
+    """
+    generate = generate_images if params["seed"] else call_stability_generate
+    tasks = {}
+    for idx, sample_seed in enumerate(split_seeds(params["seed"], params["samples"]), start=1):
+        call = generate(**dict(params, samples=1, seed=sample_seed), deadline=deadline)
+        tasks[asyncio.ensure_future(call)] = idx
+    pending = set(tasks)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in sorted(done, key=tasks.get):
+                error = task.exception()
+                yield tasks[task], ([] if error else task.result()), error
+    finally:
+        for task in pending:
+            task.cancel()
+
+# Embeds sharing one url are shown by Discord as a single gallery
+RESULT_EMBED_URL = "https://stability.ai/"
+
+def filter_reason(r: dict) -> str | None:
+    """finish_reason when the sample was caught by Stability's content filter, else None."""
+    finish = (r.get("finish_reason") or "").upper() if r.get("finish_reason") else "UNKNOWN"
+    if "FILTER" in finish or "CONTENT" in finish:
+        return finish
+    return None
+
+class ResultMessage:
+    """
+    All samples of a job in one followup: one attachment per image, shown as a
+    gallery (first embed carries the settings and every seed), with filter notices
+    merged into the message content. send() posts everything in one call;
+    publish() posts the first image and edits the same message for later ones,
+    with embeds only for what is actually attached; finish() flushes notices
+    that arrived after the last image.
+    Images are re-encoded when needed so the message fits the guild's upload limit.
+    """
+    def __init__(self, job: Job, followup: discord.Webhook):
+        self.job = job
+        self.followup = followup
+        self.filenames = []
+        self.seeds = []
+        self.notices = []
+        self.message = None
+        self.published = []  # filenames attached to `message`, in order
+        self._seed_of = {}   # filename -> seed
+        self._shown_notices = 0
+        self.grid_filename = None  # set when the images are sent as one composited grid
+
+    @property
+    def image_count(self) -> int:
+        return len(self.seeds)
+
+    @property
+    def budget(self) -> int:
+        """Bytes available per attachment (a little is kept for the multipart overhead)."""
+        return int(self.job.upload_limit * 0.95) // max(1, self.job.params["samples"])
+
+    def _register(self, idx: int, r: dict) -> bool:
+        """Records the sample's seed, or a notice when it was filtered; returns False for filtered samples."""
+        reason = filter_reason(r)
+        if reason:
+            self.notices.append(f"⚠️ {idx}. örnek **güvenlik filtresine takıldı** (finish_reason={reason}).")
+            return False
+        self.seeds.append(r.get("seed"))
+        return True
+
+    async def add(self, idx: int, r: dict) -> discord.File | None:
+        """Registers a sample; returns its attachment, or None when it was filtered."""
+        if not self._register(idx, r):
+            return None
+        filename = f"stability_{int(time.time())}_{idx}.png"
+        data, ext = await fit_for_upload(r["bytes"], self.budget, f"{self.job.id}_{idx}.png")
+        if ext:
+            filename = filename[:-3] + ext
+        self.filenames.append(filename)
+        self._seed_of[filename] = r.get("seed")
+        return discord.File(io.BytesIO(data), filename=filename)
+
+    def _content(self) -> str | None:
+        return "\n".join(self.notices) or None
+
+    def _embeds(self, filenames: list[str] | None = None) -> list[discord.Embed]:
+        """Embeds for `filenames` (default: every registered image) or for the grid."""
+        p = self.job.params
+        filenames = self.filenames if filenames is None else filenames
+        if self.grid_filename:
+            seeds = ", ".join(str(seed) for seed in self.seeds) + " (soldan sağa, yukarıdan aşağı)"
+        else:
+            seeds = ", ".join(str(self._seed_of[filename]) for filename in filenames)
+        first = make_result_embed(p["prompt"], p["negative_prompt"], p["model"], seeds, p["width"], p["height"], p["steps"], p["samples"], p["cfg_scale"])
+        if self.grid_filename:
+            first.set_image(url=f"attachment://{self.grid_filename}")
+            return [first]
+        first.url = RESULT_EMBED_URL
+        first.set_image(url=f"attachment://{filenames[0]}")
+        embeds = [first]
+        for filename in filenames[1:]:
+            embeds.append(discord.Embed(url=RESULT_EMBED_URL).set_image(url=f"attachment://{filename}"))
+        return embeds
+
+    async def send_grid(self, results: list[dict]):
+        """Composites the unfiltered samples into one grid image and sends it as the only attachment."""
+        images = [r["bytes"] for idx, r in enumerate(results, start=1) if self._register(idx, r)]
+        grid = await cpu_pool.run_process(compose_grid, images, GRID_FORMAT, GRID_QUALITY)
+        ext = GRID_EXTENSIONS[GRID_FORMAT]
+        grid, new_ext = await fit_for_upload(grid, int(self.job.upload_limit * 0.95), f"{self.job.id}_grid.{ext}")
+        self.grid_filename = f"stability_{int(time.time())}_grid.{new_ext or ext}"
+        await self.send([discord.File(io.BytesIO(grid), filename=self.grid_filename)])
+
+    async def send(self, files: list[discord.File]):
+        if not files:
+            return
+        await self.followup.send(content=self._content(), embeds=self._embeds(), files=files)
+        metrics.inc("discord.result_messages")
+
+    async def publish(self, file: discord.File | None):
+        if file is None:
+            return  # filtered: its notice goes out with the next image or in finish()
+        self.published.append(file.filename)
+        self._shown_notices = len(self.notices)
+        if self.message is None:
+            self.message = await self.followup.send(content=self._content(), embeds=self._embeds(self.published),
+                                                    files=[file], wait=True)
+        else:
+            self.message = await self.followup.edit_message(self.message.id, content=self._content(),
+                                                            embeds=self._embeds(self.published),
+                                                            attachments=[*self.message.attachments, file])
+        metrics.inc("discord.result_messages")
+
+    async def finish(self):
+        """Edits in the filter notices that came after the last published image."""
+        if self.message is None or len(self.notices) == self._shown_notices:
+            return
+        self._shown_notices = len(self.notices)
+        self.message = await self.followup.edit_message(self.message.id, content=self._content(),
+                                                        embeds=self._embeds(self.published),
+                                                        attachments=self.message.attachments)
+
+async def iter_job_samples(job: Job, errors: list):
+    """
+    Yields (index, sample) for the job as soon as each sample is decoded.
+    Failed fanned-out samples are appended to `errors` instead of stopping the others.
+    """
+    p = job.params
+    if SPLIT_SAMPLES and p["samples"] > 1:
+        async with aclosing(iter_split_generate(p, job.deadline)) as stream:
+            async for idx, results, error in stream:
+                if error is not None:
+                    errors.append(error)
+                    print(f"Job {job.id} sample {idx} failed: {error}")
+                    continue
+                for r in results:
+                    yield idx, r
+        return
+    if p["seed"]:
+        # seeded: served from the cache / shared with identical in-flight jobs
+        for idx, r in enumerate(await generate_images(**p, deadline=job.deadline), start=1):
+            yield idx, r
+        return
+    idx = 0
+    async with aclosing(iter_stability_generate(**p, deadline=job.deadline)) as stream:
+        async for r in stream:
+            idx += 1
+            yield idx, r
+
+_PIPELINE_END = object()
+
+async def run_sample_pipeline(job: Job, samples, out: ResultMessage, progressive: bool):
+    """
+    decode -> encode -> upload as three tasks joined by bounded queues
+    (PIPELINE_BUFFER items each). With `progressive`, sample N+1 is decoded and
+    encoded while sample N uploads, and only a few samples are in memory at once.
+    Otherwise the upload stage collects every encoded file and sends them in one
+    message at the end, so decoding still overlaps encoding but all files are held
+    until then.
+    """
+    decoded = asyncio.Queue(maxsize=max(1, PIPELINE_BUFFER))
+    encoded = asyncio.Queue(maxsize=max(1, PIPELINE_BUFFER))
+
+    async def decode_stage():
+        async with aclosing(samples) as stream:
+            async for item in stream:
+                await decoded.put(item)
+        await decoded.put(_PIPELINE_END)
+
+    async def encode_stage():
+        while (item := await decoded.get()) is not _PIPELINE_END:
+            idx, r = item
+            await encoded.put(await out.add(idx, r))  # None for filtered samples
+        await encoded.put(_PIPELINE_END)
+
+    async def upload_stage():
+        files = []
+        while (file := await encoded.get()) is not _PIPELINE_END:
+            if job.state == "running":
+                job_queue.set_state(job, "uploading")
+            if progressive:
+                await out.publish(file)
+            elif file is not None:
+                files.append(file)
+        if progressive:
+            await out.finish()
+        else:
+            await out.send(files)
+
+    tasks = [asyncio.ensure_future(stage()) for stage in (decode_stage, encode_stage, upload_stage)]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+async def until_deadline(samples, deadline: float, status: dict):
+    """
+    Passes samples through until `deadline` (time.monotonic()). When it passes, the
+    upstream calls are cancelled and status["timed_out"] is set, ending the stream
+    early so the samples already produced are still encoded and uploaded.
+    """
+    async with aclosing(samples) as stream:
+        while True:
+            try:
+                item = await asyncio.wait_for(anext(stream), timeout=max(0.0, deadline - time.monotonic()))
+            except StopAsyncIteration:
+                return
+            except asyncio.TimeoutError:
+                status["timed_out"] = True
+                return
+            status["produced"] += 1
+            yield item
+
+async def generate_and_send(job: Job, followup: discord.Webhook) -> ResultMessage:
+    """
+    Generates the job's images and posts them in a single followup message.
+    Only generation is bounded by the deadline; DEADLINE_MARGIN is left for the upload.
+    """
+    p = job.params
+    out = ResultMessage(job, followup)
+    errors = []
+    status = {"timed_out": False, "produced": 0}
+    samples = until_deadline(iter_job_samples(job, errors), job.deadline - DEADLINE_MARGIN, status)
+    # split mode is progressive: the message is posted with the first sample and grows as the others arrive
+    progressive = SPLIT_SAMPLES and p["samples"] > 1
+    if GRID_MODE and not progressive and p["samples"] > 1:
+        results = [r async for _, r in samples]
+        if status["timed_out"] and not results:
+            raise GenerationTimeoutError()
+        if not results:
+            raise NoImagesError()
+        job_queue.set_state(job, "uploading")
+        if sum(1 for r in results if not filter_reason(r)) > 1:
+            await out.send_grid(results)
+        else:
+            files = [await out.add(idx, r) for idx, r in enumerate(results, start=1)]
+            await out.send([f for f in files if f is not None])
+        return out
+
+    await run_sample_pipeline(job, samples, out, progressive)
+    if status["timed_out"] and not status["produced"]:
+        raise GenerationTimeoutError()
+    if errors and len(errors) == p["samples"]:
+        raise errors[0]
+    if errors:
+        refund_credits(job.user_id, job.guild_id, job.cost * len(errors) / p["samples"])
+        await followup.send(f"{len(errors)} örnek üretilemedi, diğerleri gönderildi. Başarısız örneklerin kredisi iade edildi.", ephemeral=True)
+    if status["timed_out"]:
+        # calls that finished were billed upstream, so the rest of the cost is kept
+        metrics.inc("jobs.partial_deadline")
+        await followup.send("Bazı örnekler zamanında üretilemedi; tamamlananlar gönderildi.", ephemeral=True)
+    elif not errors and not out.image_count and not out.notices:
+        raise NoImagesError()
+    return out
+
+async def run_job(job: Job):
+    p = job.params
+    followup = job.followup()
+    time_left = job.deadline - time.monotonic() - DEADLINE_MARGIN
+    if time_left < job.estimated_duration():
+        # it can no longer finish before the token expires: don't pay for it
+        metrics.inc("jobs.dropped_deadline")
+        job_queue.set_state(job, "failed", "deadline")
+        refund_credits(job.user_id, job.guild_id, job.cost)
+        await followup.send("Sıra çok uzun sürdü, isteğin zamanında tamamlanamayacağı için iptal edildi. Kredilerin iade edildi, tekrar deneyebilirsin.", ephemeral=True)
+        return
+    job_queue.set_state(job, "running")
+    if job.progress_text is not None:
+        await edit_progress(job, f"🎨 Üretiliyor… • Tahmini süre: ~{format_eta(job.estimated_duration())}", force=True)
+    try:
+        out = await generate_and_send(job, followup)
+    except GenerationTimeoutError:
+        # no upstream call completed, so nothing was billed for it
+        metrics.inc("jobs.cancelled_deadline")
+        job_queue.set_state(job, "failed", "deadline")
+        refund_credits(job.user_id, job.guild_id, job.cost)
+        await followup.send("Üretim zamanında tamamlanamadı ve iptal edildi. Kredilerin iade edildi.", ephemeral=True)
+        return
+    except NoImagesError:
+        job_queue.set_state(job, "failed", "no images")
+        await followup.send("Hiçbir görsel üretilmedi veya beklenmeyen bir cevap alındı.", ephemeral=True)
+        return
+    except discord.HTTPException:
+        raise
+    except Exception as e:
+        job_queue.set_state(job, "failed", str(e))
+        # nothing was generated, so the credits go back
+        refund_credits(job.user_id, job.guild_id, job.cost)
+        await followup.send(f"API isteği sırasında hata oluştu: `{str(e)}`", ephemeral=True)
+        return
+
+    try:
+        log_usage(job.user_id, job.username, p["prompt"], p["negative_prompt"], p["model"], p["seed"], p["width"], p["height"], p["steps"], p["samples"], p["cfg_scale"])
+    except Exception:
+        pass
+    if out.notices:
+        filter_history.record(p["prompt"])
+
+    if job.progress_text is not None:
+        # the results went out as new followups; drop the stale progress message
+        try:
+            await followup.delete_message("@original")
+        except discord.HTTPException:
+            pass
+
+    if not out.image_count:
+        job_queue.set_state(job, "failed", "filtered")
+        notices = "".join(line + "\n" for line in out.notices)
+        await followup.send(notices + "Görsel oluşturulamadı (muhtemelen içerik filtresine takıldı). Prompt içeriğini gözden geçir ve tekrar dene.", ephemeral=True)
+        return
+    job_queue.set_state(job, "done")
+
+async def cached_job_samples(p: dict) -> list[tuple[int, dict]] | None:
+    """
+    All (index, sample) pairs of a seeded request when every one of them is in the
+    result cache (per fanned-out seed in split mode), else None.
+    """
+    if not p["seed"] or not result_cache.enabled:
+        return None
+    if SPLIT_SAMPLES and p["samples"] > 1:
+        calls = [(idx, dict(p, samples=1, seed=s)) for idx, s in enumerate(split_seeds(p["seed"], p["samples"]), start=1)]
+    else:
+        calls = [(None, p)]
+    keys = [ResultCache.key_for(generation_key(**params)) for _, params in calls]
+    if not all(key in result_cache for key in keys):
+        return None
+    samples = []
+    for (idx, _), key in zip(calls, keys):
+        results = await result_cache.get(key)
+        if results is None:
+            return None  # evicted or unreadable since the check
+        samples.extend((idx or i, r) for i, r in enumerate(results, start=1))
+    return samples
+
+async def send_cached(job: Job, followup: discord.Webhook, samples: list[tuple[int, dict]]):
+    """Answers a fully cached request right away: no queue, limiter slot or credits involved."""
+    p = job.params
+    out = ResultMessage(job, followup)
+    results = [r for _, r in samples]
+    if GRID_MODE and sum(1 for r in results if not filter_reason(r)) > 1:
+        await out.send_grid(results)
+    else:
+        files = [await out.add(idx, r) for idx, r in samples]
+        await out.send([f for f in files if f is not None])
+    metrics.inc("jobs.served_from_cache")
+    try:
+        log_usage(job.user_id, job.username, p["prompt"], p["negative_prompt"], p["model"], p["seed"], p["width"], p["height"], p["steps"], p["samples"], p["cfg_scale"])
+    except Exception:
+        pass
+    if not out.image_count:
+        notices = "".join(line + "\n" for line in out.notices)
+        await followup.send(notices + "Görsel oluşturulamadı (muhtemelen içerik filtresine takıldı). Prompt içeriğini gözden geçir ve tekrar dene.", ephemeral=True)
+
+# worker tasks currently inside run_job; shutdown waits for these and cancels the idle ones
+busy_workers = set()
+
+async def job_worker():
+    while not job_queue.closed:
+        # hold a limiter slot before popping, so the job starts right away and the fair
+        # scheduler (not the limiter's FIFO) decides who goes next; no slot is held while idle
+        await job_queue.wait_nonempty()
+        await generation_limiter.acquire()
+        slot = ReservedSlot(generation_limiter)
+        if job_queue.closed:
+            slot.release()
+            return
+        try:
+            job = job_queue.get_nowait()
+        except asyncio.QueueEmpty:
+            slot.release()  # another worker took it
+            continue
+        token = reserved_slot.set(slot)
+        busy_workers.add(asyncio.current_task())
+        try:
+            await run_job(job)
+        except Exception as e:
+            # usually the interaction token expired or the webhook was deleted
+            job_queue.set_state(job, "failed", str(e))
+            print(f"Job {job.id} failed: {e}")
+        finally:
+            busy_workers.discard(asyncio.current_task())
+            slot.release()
+            reserved_slot.reset(token)
+
 @tree.command(name="resim", description="Stability AI ile resim üret (text-to-image)")
 @app_commands.describe(
     prompt="Resim için Türkçe/İngilizce prompt (zorunlu)",
@@ -196,22 +2576,22 @@ async def slash_resim(interaction: discord.Interaction,
                       seed: int | None = None,
                       model: str | None = None):
     uid = interaction.user.id
-    now = time.time()
-    last = last_request.get(uid, 0)
-    if now - last < USER_COOLDOWN:
-        await interaction.response.send_message(f"Lütfen `{int(USER_COOLDOWN - (now - last))}` saniye bekle ve tekrar dene.", ephemeral=True)
+    wait = cooldowns.remaining(uid)
+    if wait > 0:
+        await interaction.response.send_message(f"Lütfen `{int(wait)}` saniye bekle ve tekrar dene.", ephemeral=True)
         return
-    last_request[uid] = now
+    cooldowns.start(uid)
 
     if model is None:
         model = DEFAULT_MODEL
 
-    if prompt_blocked(prompt) or (negative_prompt and prompt_blocked(negative_prompt)):
+    blocked = find_blocked_term(prompt) or (negative_prompt and find_blocked_term(negative_prompt))
+    if blocked:
+        print(f"Prompt blocked for {interaction.user} ({uid}): matched {blocked!r} (lists v{moderation.version})")
+        metrics.inc("prompts.blocked")
         await interaction.response.send_message("Girilen prompt engellendi (güvenlik/anahtar kelime).", ephemeral=True)
         return
 
-    await interaction.response.defer(thinking=True)
-
     steps = max(10, min(80, int(steps)))
     cfg_scale = max(1.0, min(30.0, float(cfg_scale)))
     width = int(width)
@@ -220,61 +2600,110 @@ async def slash_resim(interaction: discord.Interaction,
     if height not in (256, 512, 768, 1024): height = 512
     samples = max(1, min(4, int(samples)))
 
-    try:
-        results = await call_stability_generate(prompt=prompt,
-                                                negative_prompt=negative_prompt,
-                                                steps=steps,
-                                                cfg_scale=cfg_scale,
-                                                width=width,
-                                                height=height,
-                                                samples=samples,
-                                                seed=seed,
-                                                model=model)
-    except Exception as e:
-        await interaction.followup.send(f"API isteği sırasında hata oluştu: `{str(e)}`", ephemeral=True)
+    prefiltered = filter_history.blocked(prompt)
+    metrics.inc("prefilter.checks")
+    metrics.inc("prefilter.hits", int(prefiltered))
+    metrics.set_gauge("prefilter.hit_rate", metrics.counters["prefilter.hits"] / metrics.counters["prefilter.checks"])
+    if prefiltered:
+        metrics.inc("prefilter.credits_saved", estimate_cost(model, width, height, steps, samples))
+        await interaction.response.send_message("Bu prompt Stability içerik filtresine defalarca takıldığı için geçici olarak engellendi. Prompt içeriğini değiştirip tekrar dene.", ephemeral=True)
         return
 
-    if not results:
-        await interaction.followup.send("Hiçbir görsel üretilmedi veya beklenmeyen bir cevap alındı.", ephemeral=True)
+    cost = estimate_cost(model, width, height, steps, samples)
+    job = Job(id=uuid.uuid4().hex,
+              user_id=uid,
+              username=f"{interaction.user.name}#{interaction.user.discriminator}",
+              guild_id=interaction.guild_id,
+              application_id=interaction.application_id,
+              token=interaction.token,
+              token_expires_at=interaction.expires_at.timestamp(),
+              params={"prompt": prompt, "negative_prompt": negative_prompt, "steps": steps, "cfg_scale": cfg_scale,
+                      "width": width, "height": height, "samples": samples, "seed": seed, "model": model},
+              cost=cost,
+              upload_limit=interaction.guild.filesize_limit if interaction.guild else DEFAULT_UPLOAD_LIMIT)
+
+    # seeded results already on disk skip shedding, credits and the queue entirely
+    cached = await cached_job_samples(job.params)
+    if cached is not None:
+        await interaction.response.defer(thinking=True)
+        await send_cached(job, interaction.followup, cached)
         return
 
-    sent_files = []
-    for idx, r in enumerate(results, start=1):
-        finish = (r.get("finish_reason") or "").upper() if r.get("finish_reason") else "UNKNOWN"
-        if "FILTER" in finish or "CONTENT" in finish:
-            await interaction.followup.send(f"Üretim **güvenlik filtresine takıldı** (finish_reason={finish}). Prompt içeriğini gözden geçir ve tekrar dene.", ephemeral=True)
-            continue
+    # parameter combinations the API just rejected are answered from memory, before any credits or queueing
+    call_samples = 1 if SPLIT_SAMPLES else samples  # split mode sends single-sample calls
+    rejected = negative_cache.get(NegativeCache.key(model, width, height, steps, call_samples, cfg_scale))
+    if rejected is not None:
+        await interaction.response.send_message(f"API isteği sırasında hata oluştu: `{str(rejected)}`", ephemeral=True)
+        return
 
-        img_bytes = r["bytes"]
-        seed_val = r.get("seed")
-        filename = f"stability_{int(time.time())}_{idx}.png"
-        fp = io.BytesIO(img_bytes)
-        fp.seek(0)
+    # shed load when the queue is longer than this interaction can wait
+    time_left = (interaction.expires_at - datetime.now(timezone.utc)).total_seconds() - DEADLINE_MARGIN
+    expected = job_queue.backlog_seconds() + generation_latency.estimate(model, width, height, steps, samples)
+    if expected > time_left:
+        metrics.inc("jobs.shed_admission")
+        await interaction.response.send_message(f"Kuyruk şu an çok dolu (tahmini bekleme ~{format_eta(expected)}). Lütfen biraz sonra tekrar dene.", ephemeral=True)
+        return
 
-        embed = make_result_embed(prompt, negative_prompt, model, seed_val, width, height, steps, samples, cfg_scale)
-        file = discord.File(fp, filename=filename)
-        await interaction.followup.send(embed=embed, file=file)
-        sent_files.append(filename)
+    wait = admit_credits(uid, interaction.guild_id, cost)
+    if wait == float("inf"):
+        await interaction.response.send_message(f"Bu istek `{cost:g}` kredi tutuyor ve limitini aşıyor. Boyut, adım veya örnek sayısını düşür.", ephemeral=True)
+        return
+    if wait > 0:
+        await interaction.response.send_message(f"Kredin yetersiz (bu istek `{cost:g}` kredi). Yaklaşık `{int(wait) + 1}` saniye sonra tekrar dene.", ephemeral=True)
+        return
+
+    await interaction.response.defer(thinking=True)
+    job_queue.submit(job)
 
+def command_schema_hash(guild: discord.abc.Snowflake | None) -> str:
+    """Stable hash of the command definitions tree.sync() would upload for the scope."""
+    schema = sorted((cmd.to_dict(tree) for cmd in tree.get_commands(guild=guild)), key=lambda c: (c.get("type", 1), c["name"]))
+    return hashlib.sha256(json.dumps(schema, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+def load_sync_state() -> dict:
     try:
-        log_usage(interaction.user, prompt, negative_prompt, model, seed, width, height, steps, samples, cfg_scale)
-    except Exception:
-        pass
+        with open(COMMAND_SYNC_STATE, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
 
-    if not sent_files:
-        await interaction.followup.send("Görsel oluşturulamadı (muhtemelen içerik filtresine takıldı).", ephemeral=True)
+def save_sync_state(state: dict):
+    tmp = COMMAND_SYNC_STATE + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(tmp, COMMAND_SYNC_STATE)
+
+async def sync_commands():
+    """Syncs the slash commands once at startup, only if their schema changed since the last sync."""
+    guild = discord.Object(id=int(GUILD_ID)) if GUILD_ID else None
+    # keyed by application too, so a state file reused with another bot token still syncs
+    scope = f"{bot.application_id}:" + (f"guild:{GUILD_ID}" if GUILD_ID else "global")
+    digest = command_schema_hash(guild)
+    state = await asyncio.to_thread(load_sync_state)
+    if state.get(scope) == digest:
+        metrics.inc("commands.sync_skipped")
+        print(f"Slash commands unchanged ({scope}), sync skipped.")
+        return
+    await tree.sync(guild=guild)
+    metrics.inc("commands.synced")
+    print(f"Slash commands synced to guild {GUILD_ID}" if GUILD_ID else "Slash commands synced globally.")
+    state[scope] = digest
+    await asyncio.to_thread(save_sync_state, state)
+
+async def sync_commands_task():
+    # fire-and-forget from setup_hook: nothing awaits it, so failures are logged here
+    try:
+        await sync_commands()
+    except Exception as e:
+        metrics.inc("commands.sync_failed")
+        print(f"Slash command sync failed: {e!r}")
 
 @bot.event
 async def on_ready():
-    if GUILD_ID:
-        guild = discord.Object(id=int(GUILD_ID))
-        await tree.sync(guild=guild)
-        print(f"Slash commands synced to guild {GUILD_ID}")
-    else:
-        await tree.sync()
-        print("Slash commands synced globally.")
     print(f"Bot hazır: {bot.user} (ID: {bot.user.id})")
 
 if __name__ == "__main__":
 
+    # before bot.run: login and setup_hook already start threads (resolver, sqlite writer)
+    cpu_pool.start()
     bot.run(DISCORD_TOKEN)